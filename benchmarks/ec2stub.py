@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+'''Local stand-in for the AWS APIs used by ec2-custom.py
+
+Serves a synthetic fleet over HTTP in the XML that boto expects, so the
+inventory script can be run and measured without AWS. The fleet is generated
+on the fly from each instance's number, so large fleets cost no memory in the
+stub.
+
+ec2-custom.py is pointed at the stub by running it through this module:
+
+    python benchmarks/ec2stub.py exec PORT STATS_FILE SCRIPT [ARGS...]
+
+which makes boto talk plain HTTP with dummy credentials, sends every
+connection boto opens to 127.0.0.1:PORT (the Host header still names the
+service and region, e.g. ec2.us-east-1.amazonaws.com), runs SCRIPT and writes
+its peak RSS in KB to STATS_FILE when it exits.
+
+Supported:
+  - EC2 DescribeInstances with MaxResults/NextToken, InstanceId.N and the
+    instance-state-name, tag-key and tag:<key> filters
+  - RDS DescribeDBInstances, optionally for one DBInstanceIdentifier
+  - ELB DescribeLoadBalancers and DescribeTags: the ELK stack's Kibana and
+    Elasticsearch ELBs in each region, serving the instances of their
+    ansible_group and tagged with their CloudFormation logical ids
+  - Route53 ListHostedZones and ListResourceRecordSets with maxitems paging:
+    one private zone holding an A record for every instance
+'''
+import atexit
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+from xml.sax.saxutils import escape
+
+ANSIBLE_GROUPS = ['elk-indexer', 'elk-kibana', 'elk-elasticsearch', 'elk-scheduler']
+INSTANCE_TYPES = ['t2.micro', 't2.medium', 'm3.large', 'r3.xlarge']
+
+EC2_NAMESPACE = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+RDS_NAMESPACE = 'http://rds.amazonaws.com/doc/2013-05-15/'
+ELB_NAMESPACE = 'http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/'
+ROUTE53_NAMESPACE = 'https://route53.amazonaws.com/doc/2013-04-01/'
+
+# ELB name, CloudFormation logical id and the ansible_group it serves
+ELBS = [('elk-KibanaEx-%s', 'kibanaExternalElb', 'elk-kibana'),
+        ('elk-Elastics-%s', 'elasticsearchInternalElb', 'elk-elasticsearch')]
+
+ZONE_ID = 'Z0000000000001'
+ZONE_NAME = 'elk.internal.'
+
+INSTANCE_XML = '''<item>
+  <reservationId>r-%(number)08x</reservationId>
+  <ownerId>123456789012</ownerId>
+  <groupSet/>
+  <instancesSet><item>
+    <instanceId>%(id)s</instanceId>
+    <imageId>ami-00000001</imageId>
+    <instanceState><code>16</code><name>running</name></instanceState>
+    <privateDnsName>%(private_dns_name)s</privateDnsName>
+    <dnsName/>
+    <keyName>elk-demo</keyName>
+    <amiLaunchIndex>0</amiLaunchIndex>
+    <instanceType>%(instance_type)s</instanceType>
+    <launchTime>2015-01-01T00:00:00.000Z</launchTime>
+    <placement><availabilityZone>%(zone)s</availabilityZone><tenancy>default</tenancy></placement>
+    <monitoring><state>disabled</state></monitoring>
+    <subnetId>subnet-%(subnet)04d</subnetId>
+    <vpcId>vpc-00000001</vpcId>
+    <privateIpAddress>%(private_ip_address)s</privateIpAddress>
+    <groupSet>%(groups)s</groupSet>
+    <architecture>x86_64</architecture>
+    <rootDeviceType>ebs</rootDeviceType>
+    <rootDeviceName>/dev/xvda</rootDeviceName>
+    <virtualizationType>hvm</virtualizationType>
+    <tagSet>%(tags)s</tagSet>
+    <hypervisor>xen</hypervisor>
+  </item></instancesSet>
+</item>'''
+
+DB_INSTANCE_XML = '''<DBInstance>
+  <DBInstanceIdentifier>%(id)s</DBInstanceIdentifier>
+  <DBInstanceClass>db.m3.medium</DBInstanceClass>
+  <Engine>mysql</Engine>
+  <DBInstanceStatus>available</DBInstanceStatus>
+  <Endpoint><Address>%(address)s</Address><Port>3306</Port></Endpoint>
+  <AvailabilityZone>%(zone)s</AvailabilityZone>
+  <DBParameterGroups><DBParameterGroup>
+    <DBParameterGroupName>default.mysql5.6</DBParameterGroupName>
+    <ParameterApplyStatus>in-sync</ParameterApplyStatus>
+  </DBParameterGroup></DBParameterGroups>
+  <DBSecurityGroups><DBSecurityGroup>
+    <DBSecurityGroupName>default</DBSecurityGroupName><Status>active</Status>
+  </DBSecurityGroup></DBSecurityGroups>
+</DBInstance>'''
+
+
+class Fleet(object):
+    ''' A synthetic fleet: the same number of instances in each region, each
+    with the given number of tags and security groups, plus rds_instances
+    RDS instances per region '''
+
+    def __init__(self, regions, instances, tags=2, security_groups=1, rds_instances=0):
+        self.regions = regions
+        self.instances = instances
+        self.tags = tags
+        self.security_groups = security_groups
+        self.rds_instances = rds_instances
+
+    def instance(self, region, number):
+        ''' Returns the fields of instance number in region '''
+
+        region_number = self.regions.index(region)
+        address = region_number << 20 | number
+        private_ip_address = '10.%d.%d.%d' % (address >> 16 & 255, address >> 8 & 255, address & 255)
+
+        tags = {'Name': 'host-%d' % number,
+                'ansible_group': ANSIBLE_GROUPS[number % len(ANSIBLE_GROUPS)]}
+        for tag in range(2, self.tags):
+            tags['tag%d' % tag] = 'value-%d' % (number % 10)
+
+        return {
+            'number': number,
+            'id': 'i-%x%07x' % (region_number, number),
+            'private_dns_name': 'ip-%s.ec2.internal' % private_ip_address.replace('.', '-'),
+            'private_ip_address': private_ip_address,
+            'instance_type': INSTANCE_TYPES[number % len(INSTANCE_TYPES)],
+            'zone': region + 'abcd'[number % 4],
+            'subnet': number % 4,
+            'security_groups': [(number + offset) % 50 for offset in range(self.security_groups)],
+            'tags': tags,
+        }
+
+    def matches(self, instance, filters):
+        for name, values in filters.iteritems():
+            if name == 'instance-state-name':
+                if 'running' not in values:
+                    return False
+            elif name == 'tag-key':
+                if not set(values) & set(instance['tags']):
+                    return False
+            elif name.startswith('tag:'):
+                if instance['tags'].get(name[4:]) not in values:
+                    return False
+        return True
+
+    def describe_instances(self, region, filters, max_results, next_token, instance_ids=None):
+        ''' Returns a page of the instances in region that match filters and
+        the token of the next page, if there is one. With instance_ids, only
+        those instances are returned, in a single page. '''
+
+        if instance_ids:
+            page = []
+            for instance_id in instance_ids:
+                match = re.match(r'i-([0-9a-f])([0-9a-f]{7})$', instance_id)
+                if not match or int(match.group(1), 16) != self.regions.index(region):
+                    continue
+                number = int(match.group(2), 16)
+                if number < self.instances:
+                    instance = self.instance(region, number)
+                    if self.matches(instance, filters):
+                        page.append(instance)
+            return page, None
+
+        start = int(next_token or 0)
+        end = self.instances if not max_results else min(self.instances, start + max_results)
+        page = []
+        for number in xrange(start, end):
+            instance = self.instance(region, number)
+            if self.matches(instance, filters):
+                page.append(instance)
+        return page, (str(end) if end < self.instances else None)
+
+    def db_instances(self, region):
+        return [{'id': 'db-%d' % number,
+                 'address': 'db-%d.c0ffee.%s.rds.amazonaws.com' % (number, region),
+                 'zone': region + 'abcd'[number % 4]}
+                for number in range(self.rds_instances)]
+
+    def load_balancers(self, region):
+        ''' Returns (name, logical id, instance ids) for each ELB in region '''
+
+        load_balancers = []
+        for name, logical_id, group in ELBS:
+            number = ANSIBLE_GROUPS.index(group)
+            instance_ids = [self.instance(region, n)['id']
+                            for n in xrange(number, self.instances, len(ANSIBLE_GROUPS))]
+            load_balancers.append((name % region, logical_id, instance_ids))
+        return load_balancers
+
+    @property
+    def record_count(self):
+        return 1 + len(self.regions) * self.instances
+
+    def record(self, position):
+        ''' Returns (name, type, value) of the zone's record at position: the
+        SOA, then an A record for each instance, in name order '''
+
+        if position == 0:
+            return ZONE_NAME, 'SOA', 'ns-1.%s hostmaster.%s 1 7200 900 1209600 86400' % (ZONE_NAME, ZONE_NAME)
+        region_number, number = divmod(position - 1, self.instances)
+        instance = self.instance(self.regions[region_number], number)
+        return ('r%d-%07d.%s' % (region_number, number, ZONE_NAME), 'A',
+                instance['private_ip_address'])
+
+    def record_position(self, name):
+        ''' Returns the position of the first record named name or after it '''
+
+        match = re.match(r'r(\d+)-(\d+)\.', name or '')
+        if not match:
+            return 0
+        return 1 + int(match.group(1)) * self.instances + int(match.group(2))
+
+
+def instance_xml(instance):
+    groups = ''.join('<item><groupId>sg-%04d</groupId><groupName>security-group-%d</groupName></item>'
+                     % (group, group) for group in instance['security_groups'])
+    tags = ''.join('<item><key>%s</key><value>%s</value></item>' % (escape(key), escape(value))
+                   for key, value in sorted(instance['tags'].iteritems()))
+    fields = dict(instance, groups=groups, tags=tags)
+    return INSTANCE_XML % fields
+
+
+def query_filters(params):
+    ''' Returns the Filter.N.Name / Filter.N.Value.M parameters as a dict '''
+
+    filters = {}
+    n = 1
+    while 'Filter.%d.Name' % n in params:
+        values = []
+        m = 1
+        while 'Filter.%d.Value.%d' % (n, m) in params:
+            values.append(params['Filter.%d.Value.%d' % (n, m)])
+            m += 1
+        filters[params['Filter.%d.Name' % n]] = values
+        n += 1
+    return filters
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        query = urlparse(self.path).query
+        if length:
+            query += '&' + self.rfile.read(length)
+        params = dict((key, values[0]) for key, values in parse_qs(query).iteritems())
+
+        # ec2.us-east-1.amazonaws.com:80 -> ('ec2', 'us-east-1'); hosts
+        # without a region are us-east-1 (rds.amazonaws.com) or global
+        # (route53.amazonaws.com)
+        labels = self.headers.get('Host', '').split(':')[0].split('.')
+        service = labels[0]
+        region = labels[1] if len(labels) > 3 else None
+        if region is None and service != 'route53':
+            region = 'us-east-1'
+        action = params.get('Action')
+        if service == 'route53':
+            # Route53 is REST: /2013-04-01/hostedzone[/ZONE/rrset]
+            path = urlparse(self.path).path
+            action = 'ListResourceRecordSets' if path.endswith('/rrset') else 'ListHostedZones'
+        self.server.count(service, action)
+
+        if service == 'ec2' and action == 'DescribeInstances':
+            body = self.describe_instances(region, params)
+        elif service == 'rds' and action == 'DescribeDBInstances':
+            body = self.describe_db_instances(region, params)
+        elif service == 'elasticloadbalancing' and action == 'DescribeLoadBalancers':
+            body = self.describe_load_balancers(region)
+        elif service == 'elasticloadbalancing' and action == 'DescribeTags':
+            body = self.describe_elb_tags(region, params)
+        elif service == 'route53' and action == 'ListHostedZones':
+            body = self.list_hosted_zones()
+        elif service == 'route53' and action == 'ListResourceRecordSets':
+            body = self.list_resource_record_sets(params)
+        else:
+            self.respond(400, '<Response><Errors><Error><Code>InvalidAction</Code>'
+                              '<Message>%s %s is not stubbed</Message></Error></Errors></Response>'
+                              % (escape(service), escape(str(action))))
+            return
+        self.respond(200, body)
+
+    def describe_instances(self, region, params):
+        max_results = int(params.get('MaxResults', 0))
+        instance_ids = []
+        while 'InstanceId.%d' % (len(instance_ids) + 1) in params:
+            instance_ids.append(params['InstanceId.%d' % (len(instance_ids) + 1)])
+        page, next_token = self.server.fleet.describe_instances(
+            region, query_filters(params), max_results, params.get('NextToken'), instance_ids)
+
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<DescribeInstancesResponse xmlns="%s"><requestId>stub</requestId><reservationSet>'
+                 % EC2_NAMESPACE]
+        parts.extend(instance_xml(instance) for instance in page)
+        parts.append('</reservationSet>')
+        if next_token:
+            parts.append('<nextToken>%s</nextToken>' % next_token)
+        parts.append('</DescribeInstancesResponse>')
+        return ''.join(parts)
+
+    def describe_db_instances(self, region, params):
+        db_instances = self.server.fleet.db_instances(region)
+        if 'DBInstanceIdentifier' in params:
+            db_instances = [db for db in db_instances if db['id'] == params['DBInstanceIdentifier']]
+        return ('<DescribeDBInstancesResponse xmlns="%s"><DescribeDBInstancesResult><DBInstances>'
+                '%s</DBInstances></DescribeDBInstancesResult></DescribeDBInstancesResponse>'
+                % (RDS_NAMESPACE, ''.join(DB_INSTANCE_XML % db for db in db_instances)))
+
+    def describe_load_balancers(self, region):
+        parts = ['<DescribeLoadBalancersResponse xmlns="%s"><DescribeLoadBalancersResult>'
+                 '<LoadBalancerDescriptions>' % ELB_NAMESPACE]
+        for name, logical_id, instance_ids in self.server.fleet.load_balancers(region):
+            parts.append('<member><LoadBalancerName>%s</LoadBalancerName><Instances>' % name)
+            parts.extend('<member><InstanceId>%s</InstanceId></member>' % instance_id
+                         for instance_id in instance_ids)
+            parts.append('</Instances></member>')
+        parts.append('</LoadBalancerDescriptions></DescribeLoadBalancersResult>'
+                     '</DescribeLoadBalancersResponse>')
+        return ''.join(parts)
+
+    def describe_elb_tags(self, region, params):
+        names = [value for key, value in params.iteritems() if key.startswith('LoadBalancerNames.member.')]
+        parts = ['<DescribeTagsResponse xmlns="%s"><DescribeTagsResult><TagDescriptions>' % ELB_NAMESPACE]
+        for name, logical_id, instance_ids in self.server.fleet.load_balancers(region):
+            if name in names:
+                parts.append('<member><LoadBalancerName>%s</LoadBalancerName><Tags><member>'
+                             '<Key>aws:cloudformation:logical-id</Key><Value>%s</Value>'
+                             '</member></Tags></member>' % (name, logical_id))
+        parts.append('</TagDescriptions></DescribeTagsResult></DescribeTagsResponse>')
+        return ''.join(parts)
+
+    def list_hosted_zones(self):
+        return ('<ListHostedZonesResponse xmlns="%s"><HostedZones><HostedZone>'
+                '<Id>/hostedzone/%s</Id><Name>%s</Name><CallerReference>stub</CallerReference>'
+                '<Config><PrivateZone>true</PrivateZone></Config>'
+                '<ResourceRecordSetCount>%d</ResourceRecordSetCount>'
+                '</HostedZone></HostedZones><IsTruncated>false</IsTruncated><MaxItems>100</MaxItems>'
+                '</ListHostedZonesResponse>'
+                % (ROUTE53_NAMESPACE, ZONE_ID, ZONE_NAME, self.server.fleet.record_count))
+
+    def list_resource_record_sets(self, params):
+        fleet = self.server.fleet
+        max_items = int(params.get('maxitems') or 100)
+        start = fleet.record_position(params.get('name'))
+        if params.get('type') == 'SOA':
+            start = 0
+        end = min(fleet.record_count, start + max_items)
+
+        parts = ['<ListResourceRecordSetsResponse xmlns="%s"><ResourceRecordSets>' % ROUTE53_NAMESPACE]
+        for position in xrange(start, end):
+            name, record_type, value = fleet.record(position)
+            parts.append('<ResourceRecordSet><Name>%s</Name><Type>%s</Type><TTL>300</TTL>'
+                         '<ResourceRecords><ResourceRecord><Value>%s</Value></ResourceRecord>'
+                         '</ResourceRecords></ResourceRecordSet>' % (name, record_type, value))
+        parts.append('</ResourceRecordSets>')
+        if end < fleet.record_count:
+            name, record_type, value = fleet.record(end)
+            parts.append('<IsTruncated>true</IsTruncated><NextRecordName>%s</NextRecordName>'
+                         '<NextRecordType>%s</NextRecordType>' % (name, record_type))
+        else:
+            parts.append('<IsTruncated>false</IsTruncated>')
+        parts.append('<MaxItems>%d</MaxItems></ListResourceRecordSetsResponse>' % max_items)
+        return ''.join(parts)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    ''' Serves a Fleet on 127.0.0.1 and counts the API calls made to it '''
+
+    daemon_threads = True
+
+    def __init__(self, fleet, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.fleet = fleet
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, service, action):
+        with self.calls_lock:
+            key = '%s:%s' % (service, action)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def reset_calls(self):
+        with self.calls_lock:
+            self.calls = {}
+
+    def total_calls(self):
+        with self.calls_lock:
+            return sum(self.calls.values())
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def write_ec2_ini(path, cache_path, regions, **settings):
+    ''' Writes an ec2.ini for running ec2-custom.py against the stub. Extra
+    keyword arguments are written as additional [ec2] settings. '''
+
+    ini = {
+        'regions': ','.join(regions),
+        'regions_exclude': '',
+        'destination_variable': 'public_dns_name',
+        'vpc_destination_variable': 'private_ip_address',
+        'route53': 'False',
+        'rds': 'False',
+        'elb': 'False',
+        'all_instances': 'False',
+        'cache_path': cache_path,
+        'cache_max_age': '300',
+        'nested_groups': 'False',
+    }
+    ini.update((key, str(value)) for key, value in settings.iteritems())
+    out = open(path, 'w')
+    out.write('[ec2]\n')
+    for key in sorted(ini):
+        out.write('%s = %s\n' % (key, ini[key]))
+    out.close()
+
+
+def run_script(port, script, args, ec2_ini, stdout=None):
+    ''' Runs script with args against the stub on port and returns its peak
+    RSS in KB '''
+
+    stats = tempfile.NamedTemporaryFile(suffix='.rss', delete=False)
+    stats.close()
+    env = dict(os.environ, EC2_INI_PATH=ec2_ini)
+    try:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), 'exec', str(port),
+                               stats.name, script] + list(args),
+                              env=env, stdout=stdout or open(os.devnull, 'w'))
+        return int(open(stats.name).read())
+    finally:
+        os.unlink(stats.name)
+
+
+def exec_script(port, stats_file, script, args):
+    ''' Runs script as __main__ with boto's connections sent to the stub '''
+
+    boto_config = tempfile.NamedTemporaryFile(suffix='.cfg', delete=False)
+    boto_config.write('[Boto]\nis_secure = False\nnum_retries = 0\n'
+                      '[Credentials]\naws_access_key_id = stub\naws_secret_access_key = stub\n')
+    boto_config.close()
+    os.environ['BOTO_CONFIG'] = boto_config.name
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'BOTO_ENDPOINTS']:
+        os.environ.pop(name, None)
+
+    create_connection = socket.create_connection
+
+    def create_stub_connection(address, *args, **kwargs):
+        return create_connection(('127.0.0.1', port), *args, **kwargs)
+    socket.create_connection = create_stub_connection
+
+    def write_stats():
+        os.unlink(boto_config.name)
+        out = open(stats_file, 'w')
+        out.write(str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        out.close()
+    atexit.register(write_stats)
+
+    sys.argv = [script] + args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    execfile(script, {'__name__': '__main__', '__file__': script})
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5 or sys.argv[1] != 'exec':
+        sys.exit(__doc__)
+    exec_script(int(sys.argv[2]), sys.argv[3], sys.argv[4], sys.argv[5:])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''Inventory build benchmark
+
+Times how long Ec2Inventory takes to turn a synthetic fleet into an inventory
+(add_instance for every instance, then merge_segment) without touching AWS.
+Every instance gets its own Name tag, so groups such as 'instances' and
+'tag_Name' grow with the fleet; the time per instance should stay flat as the
+fleet grows if group membership checks are constant time.
+
+Usage:
+    python benchmarks/inventory_build.py [SIZE ...]
+
+SIZE defaults to 1000 10000 100000.
+'''
+import imp
+import os
+import sys
+from time import time
+
+from boto.ec2.group import Group
+from boto.ec2.instance import Instance
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'roles', 'tower', 'files', 'ec2-custom.py')
+ec2_custom = imp.load_source('ec2_custom', SCRIPT)
+
+REGION = 'us-east-1'
+ANSIBLE_GROUPS = ['elk-indexer', 'elk-kibana', 'elk-elasticsearch', 'elk-scheduler']
+INSTANCE_TYPES = ['t2.micro', 't2.medium', 'm3.large', 'r3.xlarge']
+
+
+def synthetic_instance(n):
+    instance = Instance()
+    instance.id = 'i-%08x' % n
+    instance._state.name = 'running'
+    instance._state.code = 16
+    instance.subnet_id = 'subnet-%d' % (n % 4)
+    instance.private_ip_address = '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+    instance.private_dns_name = 'ip-%s.ec2.internal' % instance.private_ip_address.replace('.', '-')
+    instance._placement.zone = REGION + 'abcd'[n % 4]
+    instance.instance_type = INSTANCE_TYPES[n % len(INSTANCE_TYPES)]
+    instance.key_name = 'elk-demo'
+
+    group = Group()
+    group.id = 'sg-%04d' % (n % 50)
+    group.name = 'security-group-%d' % (n % 50)
+    instance.groups = [group]
+
+    instance.tags = {'Name': 'host-%d' % n,
+                     'ansible_group': ANSIBLE_GROUPS[n % len(ANSIBLE_GROUPS)]}
+    return instance
+
+
+def new_inventory():
+    ''' Returns an Ec2Inventory set up for building, without reading ec2.ini,
+    parsing arguments or calling AWS '''
+
+    inventory = ec2_custom.Ec2Inventory.__new__(ec2_custom.Ec2Inventory)
+    inventory.inventory = inventory._empty_inventory()
+    inventory.index = {}
+    inventory.all_instances = False
+    inventory.destination_variable = 'public_dns_name'
+    inventory.vpc_destination_variable = 'private_ip_address'
+    inventory.pattern_include = None
+    inventory.pattern_exclude = None
+    inventory.nested_groups = True
+    inventory.elb_enabled = False
+    inventory.route53_enabled = False
+    inventory.hostvars_include = []
+    return inventory
+
+
+def build(size):
+    instances = [synthetic_instance(n) for n in xrange(size)]
+    inventory = new_inventory()
+
+    start = time()
+    segment = inventory._empty_segment()
+    for instance in instances:
+        inventory.add_instance(instance, REGION, segment)
+    inventory.merge_segment(segment)
+    elapsed = time() - start
+
+    assert len(inventory.index) == size
+    return elapsed
+
+
+def main(sizes):
+    print '%10s %10s %16s %8s' % ('instances', 'seconds', 'us/instance', 'scale')
+    baseline = None
+    for size in sizes:
+        elapsed = build(size)
+        per_instance = elapsed / size * 1e6
+        if baseline is None:
+            baseline = per_instance
+        print '%10d %10.2f %16.1f %7.2fx' % (size, elapsed, per_instance, per_instance / baseline)
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+'''Inventory refresh memory benchmark
+
+Runs ec2-custom.py --refresh-cache against the local EC2 stub (see
+ec2stub.py) for fleets of increasing size in one region, once fetching the
+region in a single DescribeInstances call (page_size = 0) and once a page at
+a time, and reports the peak RSS of each run.
+
+Paging removes the part of the peak that comes from holding a whole region's
+API response and boto objects at once, and each segment is dropped as soon as
+it has been written and merged. What is left grows with the fleet, by about
+8 KB per instance at page_size = 1000: the inventory that is written out.
+Each host's 44 ec2_* hostvars take about 2.4 KB of it, which hostvars_include
+cuts; its own groups (instance id and Name tag), its index entry and its
+place in the shared group lists take most of the rest.
+
+Usage:
+    python benchmarks/inventory_memory.py [SIZE ...]
+
+SIZE defaults to 2000 10000 40000.
+'''
+import os
+import shutil
+import sys
+import tempfile
+
+import ec2stub
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'roles', 'tower', 'files', 'ec2-custom.py')
+REGION = 'us-east-1'
+PAGE_SIZES = [0, 1000]
+
+
+def peak_rss(server, workdir, page_size):
+    cache_path = os.path.join(workdir, 'cache-%d' % page_size)
+    ec2_ini = os.path.join(workdir, 'ec2-%d.ini' % page_size)
+    ec2stub.write_ec2_ini(ec2_ini, cache_path, [REGION], page_size=page_size)
+    return ec2stub.run_script(server.port, SCRIPT, ['--refresh-cache'], ec2_ini)
+
+
+def main(sizes):
+    print '%10s %s' % ('instances', ' '.join('%18s' % ('page_size=%d RSS' % size) for size in PAGE_SIZES))
+    for size in sizes:
+        server = ec2stub.StubServer(ec2stub.Fleet([REGION], size)).start()
+        workdir = tempfile.mkdtemp()
+        try:
+            results = [peak_rss(server, workdir, page_size) for page_size in PAGE_SIZES]
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(workdir)
+        print '%10d %s' % (size, ' '.join('%15.1f MB' % (rss / 1024.0) for rss in results))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [2000, 10000, 40000])
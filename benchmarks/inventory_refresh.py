@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''Inventory refresh benchmark
+
+Runs ec2-custom.py against the local AWS stub (see ec2stub.py) for every
+combination of the fleet sizes given, with EC2, RDS, ELB and Route53 enabled,
+and reports for each command:
+
+    --refresh-cache   rebuilding the cache from the APIs, starting empty
+    --refresh-cache   rebuilding it again over the existing cache files
+    --list            printing the inventory from the cache
+    --host            printing one host's vars from the cache
+
+its wall time (including interpreter start up), the API calls it made, its
+peak RSS and the total size of the cache files afterwards.
+
+Usage:
+    python benchmarks/inventory_refresh.py [--regions N ...] [--instances N ...]
+        [--tags N ...] [--security-groups N ...] [options]
+
+Each of --regions, --instances (per region), --tags and --security-groups
+(per instance) takes one or more values; see --help for the other settings.
+'''
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+from time import time
+
+import ec2stub
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'roles', 'tower', 'files', 'ec2-custom.py')
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1', 'ap-southeast-2',
+           'ap-northeast-1', 'sa-east-1', 'us-west-1', 'eu-central-1']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark ec2-custom.py against a local AWS stub')
+    parser.add_argument('--regions', type=int, nargs='+', default=[1],
+                        help='Number of regions, at most %d (default: 1)' % len(REGIONS))
+    parser.add_argument('--instances', type=int, nargs='+', default=[1000],
+                        help='EC2 instances per region (default: 1000)')
+    parser.add_argument('--tags', type=int, nargs='+', default=[2],
+                        help='Tags per instance, at least 2 (default: 2)')
+    parser.add_argument('--security-groups', type=int, nargs='+', default=[1],
+                        help='Security groups per instance (default: 1)')
+    parser.add_argument('--rds-instances', type=int, default=5,
+                        help='RDS instances per region (default: 5)')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='ec2.ini concurrency (default: 1)')
+    parser.add_argument('--page-size', type=int, default=0,
+                        help='ec2.ini page_size (default: 0)')
+    parser.add_argument('--cache-format', choices=['json', 'compact'], default='json',
+                        help='ec2.ini cache_format (default: json)')
+    parser.add_argument('--nested-groups', action='store_true', default=False,
+                        help='Set nested_groups in ec2.ini')
+    return parser.parse_args()
+
+
+def cache_size(cache_path):
+    size = 0
+    for directory, subdirectories, files in os.walk(cache_path):
+        size += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+    return size
+
+
+def run(server, cache_path, ec2_ini, args):
+    server.reset_calls()
+    start = time()
+    rss = ec2stub.run_script(server.port, SCRIPT, args, ec2_ini)
+    elapsed = time() - start
+    return elapsed, server.total_calls(), rss, cache_size(cache_path)
+
+
+def benchmark(options, regions, instances, tags, security_groups):
+    fleet = ec2stub.Fleet(REGIONS[:regions], instances, tags=tags, security_groups=security_groups,
+                          rds_instances=options.rds_instances)
+    host = fleet.instance(fleet.regions[0], 0)['private_ip_address']
+    commands = [('--refresh-cache (cold)', ['--refresh-cache']),
+                ('--refresh-cache', ['--refresh-cache']),
+                ('--list', ['--list']),
+                ('--host', ['--host', host])]
+
+    server = ec2stub.StubServer(fleet).start()
+    workdir = tempfile.mkdtemp()
+    try:
+        cache_path = os.path.join(workdir, 'cache')
+        ec2_ini = os.path.join(workdir, 'ec2.ini')
+        ec2stub.write_ec2_ini(ec2_ini, cache_path, fleet.regions,
+                              route53=True, rds=True, elb=True,
+                              concurrency=options.concurrency,
+                              page_size=options.page_size,
+                              cache_format=options.cache_format,
+                              nested_groups=options.nested_groups)
+        for name, args in commands:
+            elapsed, calls, rss, size = run(server, cache_path, ec2_ini, args)
+            print '%7d %9d %4d %6d  %-22s %8.2f %6d %8.1f %9.1f' % (
+                regions, instances, tags, security_groups, name,
+                elapsed, calls, rss / 1024.0, size / 1024.0)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir)
+
+
+def main():
+    options = parse_args()
+    print '%7s %9s %4s %6s  %-22s %8s %6s %8s %9s' % (
+        'regions', 'instances', 'tags', 'groups', 'command',
+        'seconds', 'calls', 'RSS MB', 'cache KB')
+    for fleet in itertools.product(options.regions, options.instances,
+                                   options.tags, options.security_groups):
+        benchmark(options, *fleet)
+
+
+if __name__ == '__main__':
+    main()
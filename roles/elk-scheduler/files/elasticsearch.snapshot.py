@@ -10,10 +10,53 @@ Usage:
                               [--bucket_name <BUCKET_NAME>] [--bucket_region <BUCKET_REGION>] 
                               [--key_name_prefix <KEY_NAME_PREFIX>] [--indices <INDICES>]
                               [--streams <STREAMS>] [--snapshot_id <SNAPSHOT_ID>]
+                              [--wait] [--poll_max <SECONDS>]
+                              [--group_by <GROUP_BY>] [--group_size <MB>] [--parallel <N>]
+                              [--incremental] [--state_dir <DIR>] [--timeout <SECONDS>] [--retries <N>]
+                              [--metrics <SINK>] [--chunk_size <SIZE>] [--s3_endpoint <URL>]
+    elasticsearch.snapshot.py status <ES_ENDPOINT> --repo_name <REPO_NAME> --snapshot_id <SNAPSHOT_ID>
+                              [--wait] [--poll_max <SECONDS>] [--timeout <SECONDS>] [--retries <N>]
+                              [--metrics <SINK>] [--bucket_region <BUCKET_REGION>]
     elasticsearch.snapshot.py restore <ES_ENDPOINT> --repo_name <REPO_NAME> --snapshot_id <SNAPSHOT_ID>
                               [--bucket_name <BUCKET_NAME>] [--bucket_region <BUCKET_REGION>] 
                               [--key_name_prefix <KEY_NAME_PREFIX>] [--indices <INDICES>]
-                              [--streams <STREAMS>] 
+                              [--streams <STREAMS>] [--max_recoveries <N>] [--poll_max <SECONDS>]
+                              [--timeout <SECONDS>] [--retries <N>] [--metrics <SINK>]
+                              [--chunk_size <SIZE>] [--s3_endpoint <URL>]
+    elasticsearch.snapshot.py restore <ES_ENDPOINT> --repo_name <REPO_NAME> --from <DATE> --to <DATE>
+                              [--bucket_name <BUCKET_NAME>] [--bucket_region <BUCKET_REGION>]
+                              [--key_name_prefix <KEY_NAME_PREFIX>] [--streams <STREAMS>]
+                              [--max_recoveries <N>] [--poll_max <SECONDS>] [--state_dir <DIR>] [--refresh_catalog]
+                              [--timeout <SECONDS>] [--retries <N>] [--metrics <SINK>]
+                              [--chunk_size <SIZE>] [--s3_endpoint <URL>]
+    elasticsearch.snapshot.py find <ES_ENDPOINT> --repo_name <REPO_NAME>
+                              [--index <INDEX>] [--from <DATE>] [--to <DATE>]
+                              [--state_dir <DIR>] [--refresh_catalog] [--timeout <SECONDS>] [--retries <N>]
+    elasticsearch.snapshot.py prune <ES_ENDPOINT> --repo_name <REPO_NAME>
+                              [--keep_hourly <N>] [--keep_daily <N>] [--keep_weekly <N>]
+                              [--max_age <DAYS>] [--dry_run] [--poll_max <SECONDS>]
+                              [--timeout <SECONDS>] [--retries <N>] [--metrics <SINK>]
+                              [--bucket_region <BUCKET_REGION>] [--state_dir <DIR>]
+    elasticsearch.snapshot.py verify <ES_ENDPOINT> --repo_name <REPO_NAME>
+                              [--bucket_name <BUCKET_NAME>] [--bucket_region <BUCKET_REGION>]
+                              [--key_name_prefix <KEY_NAME_PREFIX>] [--streams <STREAMS>]
+                              [--chunk_size <SIZE>] [--s3_endpoint <URL>] [--timeout <SECONDS>] [--retries <N>]
+    elasticsearch.snapshot.py schedule <ES_ENDPOINT> --repo_name <REPO_NAME>
+                              [--create_every <MINUTES>] [--prune_every <MINUTES>] [--verify_every <MINUTES>]
+                              [--max_queue <N>] [--defer_max <MINUTES>]
+                              [--bucket_name <BUCKET_NAME>] [--bucket_region <BUCKET_REGION>]
+                              [--key_name_prefix <KEY_NAME_PREFIX>] [--indices <INDICES>]
+                              [--streams <STREAMS>] [--poll_max <SECONDS>]
+                              [--group_by <GROUP_BY>] [--group_size <MB>] [--parallel <N>]
+                              [--incremental] [--state_dir <DIR>]
+                              [--keep_hourly <N>] [--keep_daily <N>] [--keep_weekly <N>] [--max_age <DAYS>]
+                              [--timeout <SECONDS>] [--retries <N>] [--metrics <SINK>]
+                              [--chunk_size <SIZE>] [--s3_endpoint <URL>]
+    elasticsearch.snapshot.py bench <ES_ENDPOINT> --bucket_name <BUCKET_NAME>
+                              [--bucket_region <BUCKET_REGION>] [--key_name_prefix <KEY_NAME_PREFIX>]
+                              [--bench_size <MB>] [--bench_shards <N>]
+                              [--bench_streams <LIST>] [--bench_chunks <LIST>] [--s3_endpoint <URL>]
+                              [--poll_max <SECONDS>] [--timeout <SECONDS>] [--retries <N>]
 
 
 Options:
@@ -25,53 +68,1565 @@ Options:
     --key_name_prefix <KEY_NAME_PREFIX> s3 key name prefix to prepend to the s3 path where the repository should be placed if it does not exist [Default: backups/elasticsearch/]
     --indices <INDICES>                 set, list or identifier for which indices to take action on [Default: *]
     --streams <STREAMS>                 Number of concurrent streams to use when performing snapshots [Default: 20]
+    --chunk_size <SIZE>                 Size of the pieces big files are split into in S3 when the repository is created, e.g. 100mb. The plugin's own default when not given
+    --s3_endpoint <URL>                 S3-compatible service to use instead of S3 itself, e.g. http://fakes3.internal:4567. The Elasticsearch nodes must be able to reach it
     --snapshot_id <SNAPSHOT_ID>         Optional name to assign to the snapshot being created or restored.
+    --wait                              Follow the snapshot until it finishes, reporting the bytes copied and throughput of each shard
+    --poll_max <SECONDS>                Longest time to wait between two progress checks. Checks start a second apart and back off up to this [Default: 30]
+    --group_by <GROUP_BY>               Snapshot the indices in groups, each as its own snapshot named <SNAPSHOT_ID>-<group>, and wait for all of them: 'date' for a group per day of daily indices such as logstash-2015.01.31, 'size' for groups of up to --group_size MB with their shards spread evenly across the nodes
+    --group_size <MB>                   Largest group of indices to snapshot at once with --group_by size [Default: 10240]
+    --incremental                       Only snapshot the indices that changed since they were last snapshotted into a snapshot still in the repository
+    --state_dir <DIR>                   Directory to keep track of the indices snapshotted in, per repository [Default: ~/.esSnapshot]
+    --parallel <N>                      Number of group snapshots to run at once. Elasticsearch 1.x runs one snapshot at a time per cluster, the others wait their turn [Default: 1]
+    --keep_hourly <N>                   Number of hours to keep the last snapshot of, counting back from the newest [Default: 24]
+    --keep_daily <N>                    Number of days to keep the last snapshot of [Default: 7]
+    --keep_weekly <N>                   Number of weeks to keep the last snapshot of [Default: 4]
+    --max_age <DAYS>                    Leave the snapshots older than this many days out of --keep_hourly, --keep_daily and --keep_weekly
+    --dry_run                           Print what prune would delete without deleting anything
+    --timeout <SECONDS>                 Longest time to wait for Elasticsearch to answer a request. Snapshot deletes, which copy nothing but can take minutes on S3, get at least 10 minutes [Default: 30]
+    --retries <N>                       Number of times to retry a request Elasticsearch turns away as too busy (429 or 503) or that gets no answer [Default: 3]
+    --metrics <SINK>                    Where to publish the duration, size, shard count, throughput and failures of each snapshot, restore and prune: cloudwatch, cloudwatch:<NAMESPACE>, statsd:<HOST>[:<PORT>] or file:<PATH>
+    --create_every <MINUTES>            How often schedule runs create, following each snapshot to its end
+    --prune_every <MINUTES>             How often schedule runs prune
+    --verify_every <MINUTES>            How often schedule checks that every node can write to the repository
+    --max_queue <N>                     Longest bulk, index or search thread pool queue, on any node, schedule starts a create or prune with [Default: 50]
+    --defer_max <MINUTES>               Longest time schedule puts off a create or prune while the cluster is busier than --max_queue allows [Default: 120]
+    --bench_size <MB>                   Size of the synthetic index bench snapshots [Default: 1024]
+    --bench_shards <N>                  Number of shards of the synthetic index, best set to the number of data nodes [Default: 3]
+    --bench_streams <LIST>              Comma separated concurrent_streams settings for bench to try [Default: 5,10,20,40]
+    --bench_chunks <LIST>               Comma separated chunk_size settings for bench to try [Default: 100mb,1gb]
+    --index <INDEX>                     Index find looks for the newest snapshot of
+    --from <DATE>                       First day, as YYYY.MM.DD, of the daily indices to find or restore
+    --to <DATE>                         Last day, as YYYY.MM.DD, of the daily indices to find or restore
+    --refresh_catalog                   List the whole repository to rebuild the local catalog of snapshots before looking in it
+    --max_recoveries <N>                Most shards to restore at once. Indices are restored in batches of up to this many shards, the undated ones (such as kibana-int) first and then the daily ones newest first [Default: 10]
+
+create --wait, create --group_by and status exit with a status that reflects
+the state of the snapshot: 0 when it succeeded, 1 when it failed, 2 when it is
+partial (some shards failed) and 3 when it is still running (status
+without --wait). When snapshotting in groups, the status is that of the worst group.
+
+With --incremental, an index counts as changed when its primaries' doc count,
+deleted doc count or store size differs from when it was last snapshotted, or
+when the snapshot it was last snapshotted in is gone from the repository or
+did not finish with a good copy of it.
+
+restore follows each batch of indices until all their primary shards are
+recovered, reporting the bytes copied and throughput of each shard, and exits
+with 0 once every batch is restored. It exits with 1 and stops at the first
+batch that fails, such as one with a primary shard left unassigned after
+its restore failed.
+
+Metrics are published for each snapshot that create (in groups or with the
+wait option) or status with the wait option follows to its end, and for each
+restore and prune. They go to CloudWatch in the bucket region, under the
+namespace Elasticsearch/Snapshots by default, with the repository as the
+Repository dimension; to StatsD as <repository>.<metric>, timings in
+milliseconds and the rest as gauges; or to a file as a JSON object per line.
+Failing to publish them is reported and does not fail the command.
+
+schedule checks the repository once, when it starts, and then runs its jobs
+one at a time. Each job first runs at start up and then every so many
+minutes; runs missed while another job ran are skipped rather than caught up.
+create and prune take a lock in the state directory, so they never overlap
+with each other either, whether run by schedule or from cron; while it is
+held, they exit with 3 and schedule tries again a minute later. It rides out
+Elasticsearch being unreachable: the repository check at start up is retried
+until it succeeds, and a job whose cluster load check fails is tried again a
+minute later.
+
+bench measures what the repository settings are worth before picking them. It
+creates a synthetic index of random documents, then for every pair of stream
+and chunk settings creates a throwaway repository under
+<KEY_NAME_PREFIX>bench/ and snapshots the index into it, so that each
+snapshot copies every file. It prints the MB/s of each, recommends the
+fastest (or, within 5% of it, the one with fewest streams) and deletes the
+snapshots, the repositories and the index.
+
+find and restore with --from and --to look the snapshots up in a catalog kept
+in the state directory, which create and prune update as they go, rather than
+listing the whole repository. restore with dates restores each daily index
+from the newest snapshot holding a good copy of it. The first lookup after
+the catalog was started, or one with --refresh_catalog, lists the repository
+to fill in the snapshots that create did not record itself.
+
+<ES_ENDPOINT> is a host, or a comma separated list of hosts such as the
+internal ELB and some of the nodes, each with :port if it is not 9200.
+Requests go to the one answering fastest; one that fails to answer is left
+alone for 30 seconds while the others take over.
+
+prune keeps the snapshots that --keep_hourly, --keep_daily and --keep_weekly
+ask for, the newest snapshot that succeeded, those still running and, for
+every open index, the newest snapshot holding a good copy of it. The group
+snapshots of a create with --group_by, which create records in the state
+directory, are kept or deleted together. The rest
+are deleted one at a time, oldest first, so that an interrupted prune leaves
+the newest snapshots in place. It exits with 1 and stops at the first
+snapshot it fails to delete.
 '''
 import requests
 from docopt import docopt
+import base64
+import fcntl
+import fnmatch
+import heapq
 import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
-args = docopt(__doc__, version='ElasticsearchSnapshot 1.0')
+# _status states of a snapshot that has not finished yet
+RUNNING_STATES = ['INIT', 'STARTED', 'WAITING']
 
-print args
+EXIT_SUCCESS = 0
+EXIT_FAILED = 1
+EXIT_PARTIAL = 2
+EXIT_RUNNING = 3
+
+# Exit statuses of finished snapshots, from best to worst
+EXIT_SEVERITY = [EXIT_SUCCESS, EXIT_PARTIAL, EXIT_FAILED]
+
+# Held while printing a report, so those of snapshots followed at the same
+# time do not run into each other
+output_lock = threading.Lock()
+
+# Date in the name of a daily index, e.g. logstash-2015.01.31
+INDEX_DATE = re.compile(r'(\d{4})[.-](\d{2})[.-](\d{2})')
+
+MB = 1024.0 * 1024.0
+
+# Snapshot deletes answer once the snapshot's files are gone from the
+# repository, which takes a while for big snapshots on S3
+SLOW_REQUEST_TIMEOUT = 600
+
+
+class ElasticsearchClient(object):
+    ''' Sends requests to one of several Elasticsearch endpoints over
+    keep-alive connections, retrying with backoff the ones that are turned
+    away as too busy or get no answer. Safe to share between threads. '''
+
+    # Seconds an endpoint that failed to answer is passed over for
+    FAILED_ENDPOINT_PAUSE = 30
+
+    def __init__(self, endpoints, timeout, retries, pool_size=10):
+        self.timeout = timeout
+        self.retries = retries
+        self.endpoints = []
+        for endpoint in endpoints.split(','):
+            endpoint = endpoint.strip()
+            if '://' not in endpoint:
+                endpoint = 'http://' + endpoint
+            if ':' not in endpoint.split('://', 1)[1]:
+                endpoint += ':9200'
+            # latency is a moving average of the seconds it takes to answer,
+            # None until it has answered once, so that each gets tried
+            self.endpoints.append({'url': endpoint.rstrip('/'), 'latency': None, 'failed_until': 0})
+        self.endpoints_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def pick_endpoint(self):
+        ''' Returns the endpoint answering fastest of those that have not
+        failed lately, or the one that failed longest ago if all have '''
+
+        now = time.time()
+        with self.endpoints_lock:
+            return min(self.endpoints, key=lambda endpoint: (max(endpoint['failed_until'], now), endpoint['latency']))
+
+    def record(self, endpoint, seconds=None):
+        ''' Records how long an endpoint took to answer, or that it failed to
+        when seconds is None '''
+
+        with self.endpoints_lock:
+            if seconds is None:
+                endpoint['failed_until'] = time.time() + self.FAILED_ENDPOINT_PAUSE
+            elif endpoint['latency'] is None:
+                endpoint['latency'] = seconds
+            else:
+                endpoint['latency'] = endpoint['latency'] * 0.7 + seconds * 0.3
+
+    def request(self, method, path, data=None, timeout=None):
+        ''' Sends a request and returns the response. Only GETs are retried
+        when the answer times out, the others may have been carried out. A
+        503 for a snapshot or restore already running is returned as it is,
+        the callers wait for that one to finish. '''
+
+        interval = 0.5
+        for attempt in range(self.retries + 1):
+            endpoint = self.pick_endpoint()
+            started = time.time()
+            try:
+                response = self.session.request(method, endpoint['url'] + path, data=data,
+                                                timeout=timeout or self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                self.record(endpoint)
+                if attempt == self.retries or \
+                        (method != 'GET' and not isinstance(e, requests.exceptions.ConnectionError)):
+                    raise RuntimeError(method + ' ' + endpoint['url'] + path + ' got no answer: ' + str(e))
+                continue
+
+            self.record(endpoint, time.time() - started)
+            if response.status_code not in [429, 503] or attempt == self.retries or \
+                    'ConcurrentSnapshotExecutionException' in response.text:
+                return response
+            if response.status_code == 503:
+                # The node cannot serve requests, e.g. it lost the master
+                self.record(endpoint)
+            time.sleep(interval)
+            interval *= 2
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+class MetricsSink(object):
+    ''' Publishes metrics, as a list of (name, value, unit) with the units
+    CloudWatch knows (Seconds, Bytes, Megabytes/Second, Count). This one
+    publishes nowhere, for when no --metrics is given. '''
+
+    def publish(self, repo_name, metrics):
+        try:
+            self.send(repo_name, metrics)
+        except Exception, e:
+            with output_lock:
+                print 'Unable to publish metrics to ' + self.__class__.__name__ + ': ' + str(e)
+
+    def send(self, repo_name, metrics):
+        pass
+
+
+class CloudWatchMetrics(MetricsSink):
+    def __init__(self, region, namespace):
+        import boto.ec2.cloudwatch
+        self.connection = boto.ec2.cloudwatch.connect_to_region(region)
+        self.namespace = namespace
+
+    def send(self, repo_name, metrics):
+        # PutMetricData takes up to 20 metrics per call
+        for start in range(0, len(metrics), 20):
+            batch = metrics[start:start + 20]
+            self.connection.put_metric_data(self.namespace,
+                                            [name for name, value, unit in batch],
+                                            [value for name, value, unit in batch],
+                                            unit=[unit for name, value, unit in batch],
+                                            dimensions=[{'Repository': repo_name}] * len(batch))
+
+
+class StatsdMetrics(MetricsSink):
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, repo_name, metrics):
+        lines = []
+        for name, value, unit in metrics:
+            if unit == 'Seconds':
+                lines.append('%s.%s:%d|ms' % (repo_name, name, value * 1000))
+            else:
+                lines.append('%s.%s:%s|g' % (repo_name, name, value))
+        self.socket.sendto('\n'.join(lines), self.address)
+
+
+class FileMetrics(MetricsSink):
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+
+    def send(self, repo_name, metrics):
+        now = time.time()
+        with self.lock:
+            metrics_file = open(self.path, 'a')
+            try:
+                for name, value, unit in metrics:
+                    metrics_file.write(json.dumps({'time': now, 'repository': repo_name, 'name': name,
+                                                   'value': value, 'unit': unit}) + '\n')
+            finally:
+                metrics_file.close()
+
+
+def get_metrics_sink(sink, region):
+    ''' Returns the metrics sink a --metrics value asks for '''
+
+    if not sink:
+        return MetricsSink()
+    kind, _, setting = sink.partition(':')
+    if kind == 'cloudwatch':
+        return CloudWatchMetrics(region, setting or 'Elasticsearch/Snapshots')
+    elif kind == 'statsd' and setting:
+        host, _, port = setting.partition(':')
+        return StatsdMetrics(host, int(port or 8125))
+    elif kind == 'file' and setting:
+        return FileMetrics(setting)
+    raise RuntimeError('--metrics must be cloudwatch, cloudwatch:<NAMESPACE>, statsd:<HOST>[:<PORT>] or file:<PATH>, not ' + sink)
+
+
+def get_snapshot_status(es, repo_name, snapshot_id):
+    ''' Returns the progress of a snapshot, per index and shard, from _status '''
+
+    status_request = es.get('/_snapshot/' + repo_name + '/' + snapshot_id + '/_status')
+    if status_request.status_code != 200:
+        raise RuntimeError('Snapshot status returned code ' + str(status_request.status_code) + ' with message ' + status_request.text)
+    return status_request.json()['snapshots'][0]
+
+
+def report_progress(status, previous):
+    ''' Prints the progress of a snapshot and of each shard being copied,
+    with the throughput since the previous report. Returns what the next
+    report needs to know about this one. '''
+
+    now = time.time()
+    elapsed = now - previous['time'] if previous else None
+
+    def throughput(processed, previous_processed):
+        if not elapsed or previous_processed is None:
+            return ''
+        return '%8.1f MB/s' % ((processed - previous_processed) / MB / elapsed)
+
+    stats = status['stats']
+    shards = status['shards_stats']
+    processed = {}
+    with output_lock:
+        print '%s %s %-8s shards %d/%d done, %d failed  %10.1f/%.1f MB %s' % (
+            datetime.now().strftime('%H:%M:%S'), status['snapshot'], status['state'], shards['done'], shards['total'],
+            shards['failed'], stats['processed_size_in_bytes'] / MB, stats['total_size_in_bytes'] / MB,
+            throughput(stats['processed_size_in_bytes'], previous and previous['processed']))
+
+        for index_name, index in sorted(status.get('indices', {}).iteritems()):
+            for shard_id, shard in sorted(index['shards'].iteritems(), key=lambda item: int(item[0])):
+                shard_key = index_name + '[' + shard_id + ']'
+                processed[shard_key] = shard['stats']['processed_size_in_bytes']
+                if shard['stage'] in ['DONE', 'FAILURE'] and previous and shard_key in previous['shards'] \
+                        and previous['shards'][shard_key] == processed[shard_key]:
+                    # Finished before the previous report, nothing new to say
+                    continue
+                print '    %-40s %-8s %10.1f/%.1f MB %s %s' % (
+                    shard_key, shard['stage'], processed[shard_key] / MB,
+                    shard['stats']['total_size_in_bytes'] / MB,
+                    throughput(processed[shard_key], previous and previous['shards'].get(shard_key)),
+                    shard.get('node', ''))
+
+    return {'time': now, 'processed': stats['processed_size_in_bytes'], 'shards': processed}
+
+
+def snapshot_result(es, repo_name, snapshot_id, status, metrics=MetricsSink()):
+    ''' Prints and publishes how a finished snapshot went and returns the
+    exit status for it. _status does not tell partial snapshots from
+    successful ones, the snapshot itself does. '''
+
+    snapshot_request = es.get('/_snapshot/' + repo_name + '/' + snapshot_id)
+    if snapshot_request.status_code != 200:
+        raise RuntimeError('Snapshot lookup returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+    snapshot = snapshot_request.json()['snapshots'][0]
+
+    stats = status['stats']
+    seconds = stats['time_in_millis'] / 1000.0
+    with output_lock:
+        print 'Snapshot %s %s in %.1fs: %.1f MB copied (%.1f MB in total) at %.1f MB/s, %d shards, %d failed' % (
+            snapshot_id, snapshot['state'], seconds, stats['processed_size_in_bytes'] / MB,
+            stats['total_size_in_bytes'] / MB, stats['processed_size_in_bytes'] / MB / max(seconds, 0.001),
+            status['shards_stats']['total'], status['shards_stats']['failed'])
+        for failure in snapshot.get('failures', []):
+            print '    %s[%s] %s' % (failure.get('index'), failure.get('shard_id'), failure.get('reason'))
+    metrics.publish(repo_name, [
+        ('SnapshotDuration', seconds, 'Seconds'),
+        ('SnapshotBytes', stats['processed_size_in_bytes'], 'Bytes'),
+        ('SnapshotShards', status['shards_stats']['total'], 'Count'),
+        ('SnapshotShardsFailed', status['shards_stats']['failed'], 'Count'),
+        ('SnapshotThroughput', stats['processed_size_in_bytes'] / MB / max(seconds, 0.001), 'Megabytes/Second'),
+        ('SnapshotFailed', 0 if snapshot['state'] == 'SUCCESS' else 1, 'Count')])
+
+    if snapshot['state'] == 'SUCCESS':
+        return EXIT_SUCCESS
+    elif snapshot['state'] == 'PARTIAL':
+        return EXIT_PARTIAL
+    return EXIT_FAILED
+
+
+def wait_for_snapshot(es, repo_name, snapshot_id, poll_max, metrics=MetricsSink()):
+    ''' Reports the progress of a snapshot until it finishes, checking a
+    second apart at first and backing off to poll_max seconds between
+    checks. Returns the exit status for how it ended. '''
+
+    interval = 1.0
+    previous = None
+    while True:
+        status = get_snapshot_status(es, repo_name, snapshot_id)
+        previous = report_progress(status, previous)
+        if status['state'] not in RUNNING_STATES:
+            return snapshot_result(es, repo_name, snapshot_id, status, metrics)
+        time.sleep(interval)
+        interval = min(interval * 2, poll_max)
+
+
+def create_snapshot(es, repo_name, snapshot_id, snapshot_data):
+    ''' Starts a snapshot and returns the response '''
+
+    return es.put('/_snapshot/' + repo_name + '/' + snapshot_id,
+                  data=json.dumps(snapshot_data))
+
+
+def get_index_stats(es, indices):
+    ''' Returns, by index, for the open indices matching indices:
+     - shards: the node and size in bytes of each primary shard, the copies
+       snapshots are taken from
+     - fingerprint: the primaries' doc count, deleted doc count and store
+       size, which change whenever the index has anything new to snapshot '''
+
+    stats_request = es.get('/' + indices + '/_stats/docs,store?level=shards')
+    if stats_request.status_code != 200:
+        raise RuntimeError('Index stats returned code ' + str(stats_request.status_code) + ' with message ' + stats_request.text)
+
+    index_stats = {}
+    for index_name, index in stats_request.json()['indices'].iteritems():
+        primaries = index['primaries']
+        index_stats[index_name] = {
+            'shards': [],
+            'fingerprint': [primaries['docs']['count'], primaries['docs']['deleted'],
+                            primaries['store']['size_in_bytes']]}
+        for shard_copies in index['shards'].itervalues():
+            for shard in shard_copies:
+                if shard['routing']['primary']:
+                    index_stats[index_name]['shards'].append(
+                        (shard['routing']['node'], shard['store']['size_in_bytes']))
+    return index_stats
+
+
+def list_snapshots(es, repo_name):
+    ''' Returns every snapshot in a repository '''
+
+    snapshots_request = es.get('/_snapshot/' + repo_name + '/_all')
+    if snapshots_request.status_code != 200:
+        raise RuntimeError('Listing snapshots returned code ' + str(snapshots_request.status_code) + ' with message ' + snapshots_request.text)
+    return snapshots_request.json()['snapshots']
+
+
+def index_state_path(state_dir, repo_name):
+    return os.path.join(os.path.expanduser(state_dir), repo_name + '.indices.json')
+
+
+def run_state_path(state_dir, repo_name):
+    return os.path.join(os.path.expanduser(state_dir), repo_name + '.runs.json')
+
+
+def load_state_file(path):
+    ''' Returns what a state file in the state directory holds, such as the
+    snapshot each index was last snapshotted in and its fingerprint then,
+    or {} when there is none yet '''
+
+    if not os.path.isfile(path):
+        return {}
+    state_file = open(path, 'r')
+    try:
+        return json.load(state_file)
+    finally:
+        state_file.close()
+
+
+def save_state_file(path, state):
+    ''' Writes a state file through a temporary file, so that it is never
+    left half-written '''
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    state_file = open(temp_path, 'w')
+    json.dump(state, state_file, sort_keys=True, indent=2)
+    state_file.close()
+    os.rename(temp_path, path)
+
+
+def unchanged_indices(index_stats, index_state, snapshots):
+    ''' Returns the indices whose fingerprint is the same as when they were
+    last snapshotted, in a snapshot that is still in the repository and
+    holds a good copy of them. A snapshot that was still running when its
+    indices were recorded counts once it has finished. '''
+
+    snapshot_copies = {}
+    for snapshot in snapshots:
+        if snapshot['state'] not in ['SUCCESS', 'PARTIAL']:
+            continue
+        failed = set(failure.get('index') for failure in snapshot.get('failures', []))
+        snapshot_copies[snapshot['snapshot']] = set(snapshot['indices']) - failed
+
+    unchanged = []
+    for index_name, index in index_stats.iteritems():
+        state = index_state.get(index_name)
+        if state and state['fingerprint'] == index['fingerprint'] and \
+                index_name in snapshot_copies.get(state['snapshot'], ()):
+            unchanged.append(index_name)
+    return sorted(unchanged)
+
+
+def record_snapshot(index_state, snapshot_id, indices, index_stats):
+    ''' Records the snapshot indices are being snapshotted in, with their
+    fingerprints from before it started '''
+
+    for index_name in indices:
+        index_state[index_name] = {'snapshot': snapshot_id,
+                                   'fingerprint': index_stats[index_name]['fingerprint']}
+
+
+class SnapshotCatalog(object):
+    ''' The snapshots of a repository, with when they ran, how they ended
+    and the size of each index in them, kept in the state directory so that
+    finding the snapshot to restore an index from does not take listing the
+    whole repository. create and prune keep it up to date as they go;
+    snapshots made or deleted some other way are picked up by the next
+    prune, create --incremental or --refresh_catalog. '''
+
+    def __init__(self, state_dir, repo_name):
+        self.path = os.path.join(os.path.expanduser(state_dir), repo_name + '.catalog.json')
+        self.repo_name = repo_name
+        catalog = load_state_file(self.path)
+        self.snapshots = catalog.get('snapshots', {})
+        # Set once the catalog has been brought in line with a full listing;
+        # until then it only knows the snapshots create happened to record
+        self.synced = catalog.get('synced', False)
+        self.lock = threading.Lock()
+
+    def save(self):
+        with self.lock:
+            save_state_file(self.path, {'synced': self.synced, 'snapshots': self.snapshots})
+
+    def add(self, snapshot, status=None):
+        ''' Records a snapshot as listed by Elasticsearch, with the size of
+        each index when its _status is given '''
+
+        sizes = {}
+        if status:
+            for index_name, index in status.get('indices', {}).iteritems():
+                sizes[index_name] = sum(shard['stats']['total_size_in_bytes'] for shard in index['shards'].itervalues())
+        with self.lock:
+            previous = self.snapshots.get(snapshot['snapshot'], {}).get('indices', {})
+            self.snapshots[snapshot['snapshot']] = {
+                'state': snapshot['state'],
+                'start': snapshot.get('start_time_in_millis', 0),
+                'end': snapshot.get('end_time_in_millis', 0),
+                'indices': dict((index_name, sizes.get(index_name, previous.get(index_name)))
+                                for index_name in snapshot['indices']),
+                'failed': sorted(set(failure.get('index') for failure in snapshot.get('failures', [])))}
+
+    def remove(self, snapshot_id):
+        with self.lock:
+            self.snapshots.pop(snapshot_id, None)
+
+    def update(self, es, snapshot_ids):
+        ''' Records how the snapshots given are doing now, and the size of
+        each index in the ones that have finished '''
+
+        for snapshot_id in snapshot_ids:
+            snapshot_request = es.get('/_snapshot/' + self.repo_name + '/' + snapshot_id)
+            if snapshot_request.status_code == 404:
+                self.remove(snapshot_id)
+                continue
+            if snapshot_request.status_code != 200:
+                raise RuntimeError('Snapshot lookup returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+            snapshot = snapshot_request.json()['snapshots'][0]
+            status = None
+            if snapshot['state'] not in ['IN_PROGRESS']:
+                status = get_snapshot_status(es, self.repo_name, snapshot_id)
+            self.add(snapshot, status)
+
+    def sync(self, snapshots):
+        ''' Brings the catalog in line with a full listing of the repository.
+        Sizes are kept for the snapshots already known, the others get
+        theirs when they are looked up. '''
+
+        listed = set()
+        for snapshot in snapshots:
+            listed.add(snapshot['snapshot'])
+            self.add(snapshot)
+        with self.lock:
+            for snapshot_id in set(self.snapshots) - listed:
+                del self.snapshots[snapshot_id]
+            self.synced = True
+
+    def refresh(self, es, rebuild=False):
+        ''' Lists the whole repository when the catalog has never been synced
+        with a listing or rebuild is set, otherwise only looks up the
+        snapshots that were still running '''
+
+        if rebuild or not self.synced:
+            self.sync(list_snapshots(es, self.repo_name))
+        else:
+            self.update(es, [snapshot_id for snapshot_id, snapshot in self.snapshots.items()
+                             if snapshot['state'] == 'IN_PROGRESS'])
+        self.save()
+
+    def good_copies(self, index_name):
+        ''' Returns the snapshots holding a good copy of an index, newest
+        first '''
+
+        return sorted([(snapshot['start'], snapshot_id) for snapshot_id, snapshot in self.snapshots.iteritems()
+                       if snapshot['state'] in ['SUCCESS', 'PARTIAL'] and index_name in snapshot['indices']
+                       and index_name not in snapshot['failed']], reverse=True)
+
+    def latest(self, index_name):
+        ''' Returns the newest snapshot holding a good copy of an index, or
+        None '''
+
+        copies = self.good_copies(index_name)
+        return copies[0][1] if copies else None
+
+    def between(self, date_from, date_to):
+        ''' Returns the newest snapshot holding a good copy of each daily
+        index dated from date_from to date_to, both as (year, month, day),
+        by index '''
+
+        index_names = set()
+        for snapshot in self.snapshots.itervalues():
+            for index_name in snapshot['indices']:
+                match = INDEX_DATE.search(index_name)
+                if match and date_from <= tuple(int(part) for part in match.groups()) <= date_to:
+                    index_names.add(index_name)
+        latest = {}
+        for index_name in index_names:
+            snapshot_id = self.latest(index_name)
+            if snapshot_id:
+                latest[index_name] = snapshot_id
+        return latest
+
+
+def parse_date(date):
+    ''' Returns a date given as YYYY.MM.DD or YYYY-MM-DD as (year, month,
+    day) '''
+
+    match = INDEX_DATE.match(date or '')
+    if not match:
+        raise RuntimeError('Dates must be given as YYYY.MM.DD or YYYY-MM-DD, not ' + str(date))
+    return tuple(int(part) for part in match.groups())
+
+
+def plan_snapshot_groups(index_shards, group_by, group_size):
+    ''' Splits indices into groups to snapshot one by one, as a list of
+    (group name, indices).
+
+    'date' makes a group of each day's indices, named after the day, and one
+    of the indices without a date in their name. 'size' packs the indices,
+    biggest first, into groups of at most group_size bytes (an index bigger
+    than that gets a group of its own). Each index goes in the group where
+    it adds least to the busiest node, so every group keeps all the nodes
+    copying rather than leaving one copying a big index alone. '''
+
+    if group_by == 'date':
+        groups = {}
+        for index_name in index_shards:
+            match = INDEX_DATE.search(index_name)
+            groups.setdefault('.'.join(match.groups()) if match else 'undated', []).append(index_name)
+        return [(name, sorted(groups[name])) for name in sorted(groups)]
+
+    def index_size(index_name):
+        return sum(size for node, size in index_shards[index_name])
+
+    def add_to_nodes(node_bytes, index_name):
+        node_bytes = dict(node_bytes)
+        for node, size in index_shards[index_name]:
+            node_bytes[node] = node_bytes.get(node, 0) + size
+        return node_bytes
+
+    groups = []
+    for index_name in sorted(index_shards, key=lambda name: (-index_size(name), name)):
+        size = index_size(index_name)
+        best_group = None
+        best_busiest = None
+        for group in groups:
+            if group['size'] + size > group_size:
+                continue
+            busiest = max(add_to_nodes(group['nodes'], index_name).values())
+            if best_group is None or busiest < best_busiest:
+                best_group = group
+                best_busiest = busiest
+
+        if best_group is None:
+            best_group = {'indices': [], 'size': 0, 'nodes': {}}
+            groups.append(best_group)
+        best_group['indices'].append(index_name)
+        best_group['size'] += size
+        best_group['nodes'] = add_to_nodes(best_group['nodes'], index_name)
+
+    return [('part%d' % (number + 1), sorted(group['indices'])) for number, group in enumerate(groups)]
+
+
+def run_snapshot_plan(es, repo_name, snapshot_id, groups, parallel, poll_max, on_started=None,
+                      metrics=MetricsSink()):
+    ''' Snapshots each group of indices as snapshot <snapshot_id>-<group>,
+    running up to parallel of them at once, and waits for all of them.
+    Elasticsearch 1.x only runs one snapshot at a time per cluster and turns
+    the others away; those wait for it to finish and try again.
+    on_started(snapshot_id, indices) is called as each snapshot starts.
+    Returns the exit status of the group that did worst. '''
+
+    pending = list(enumerate(groups))
+    pending_lock = threading.Lock()
+    results = []
+
+    def snapshot_groups():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                (number, (group_name, indices)) = pending.pop(0)
+
+            group_snapshot_id = snapshot_id + '-' + group_name
+            # The cluster's global state is saved once, with the first group
+            snapshot_data = {'indices': ','.join(indices),
+                             'ignore_unavailable': True,
+                             'include_global_state': number == 0}
+            try:
+                interval = 1.0
+                while True:
+                    snapshot_request = create_snapshot(es, repo_name, group_snapshot_id, snapshot_data)
+                    if snapshot_request.status_code != 503 or \
+                            'ConcurrentSnapshotExecutionException' not in snapshot_request.text:
+                        break
+                    time.sleep(interval)
+                    interval = min(interval * 2, poll_max)
+
+                if snapshot_request.status_code not in [200, 202]:
+                    raise RuntimeError('Creation of snapshot returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+                with output_lock:
+                    print 'Snapshot ' + group_snapshot_id + ' of ' + ', '.join(indices) + ' created.'
+                    if on_started:
+                        on_started(group_snapshot_id, indices)
+                results.append(wait_for_snapshot(es, repo_name, group_snapshot_id, poll_max, metrics))
+            except Exception, e:
+                with output_lock:
+                    print 'Snapshot ' + group_snapshot_id + ' failed: ' + str(e)
+                metrics.publish(repo_name, [('SnapshotFailed', 1, 'Count')])
+                results.append(EXIT_FAILED)
+
+    threads = [threading.Thread(target=snapshot_groups) for n in range(max(1, parallel))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return max(results or [EXIT_SUCCESS], key=EXIT_SEVERITY.index)
+
+
+def plan_restore_batches(status, indices, max_recoveries):
+    ''' Returns the indices of a snapshot that match indices, a comma
+    separated list of names or patterns, in batches of up to max_recoveries
+    shards. The indices dashboards need come first: those without a date
+    (kibana-int and the like), then the daily indices newest first. An index
+    with more shards than max_recoveries is a batch of its own. '''
+
+    patterns = indices.split(',')
+    index_shards = {}
+    for index_name, index in status['indices'].iteritems():
+        if any(fnmatch.fnmatch(index_name, pattern) for pattern in patterns):
+            index_shards[index_name] = len(index['shards'])
+
+    def priority(index_name):
+        match = INDEX_DATE.search(index_name)
+        if not match:
+            return (0, index_name)
+        return (1, tuple(-int(part) for part in match.groups()), index_name)
+
+    batches = []
+    batch_shards = 0
+    for index_name in sorted(index_shards, key=priority):
+        if not batches or batch_shards + index_shards[index_name] > max_recoveries:
+            batches.append([])
+            batch_shards = 0
+        batches[-1].append(index_name)
+        batch_shards += index_shards[index_name]
+    return batches
+
+
+def get_restore_recovery(es, indices):
+    ''' Returns the recovery of each primary shard restored from a snapshot
+    into indices that has started, by index[shard] '''
+
+    recovery_request = es.get('/' + ','.join(indices) + '/_recovery')
+    if recovery_request.status_code != 200:
+        raise RuntimeError('Recovery status returned code ' + str(recovery_request.status_code) + ' with message ' + recovery_request.text)
+
+    recoveries = {}
+    for index_name, index in recovery_request.json().iteritems():
+        for shard in index['shards']:
+            if shard['primary'] and shard['type'] == 'SNAPSHOT':
+                recoveries[index_name + '[' + str(shard['id']) + ']'] = shard
+    return recoveries
+
+
+def get_failed_primaries(es, indices):
+    ''' Returns the primary shards of indices that are neither active nor
+    being recovered, which is where a shard whose restore failed is left '''
+
+    health_request = es.get('/_cluster/health/' + ','.join(indices) + '?level=shards')
+    if health_request.status_code != 200:
+        raise RuntimeError('Cluster health returned code ' + str(health_request.status_code) + ' with message ' + health_request.text)
+
+    failed = []
+    for index_name, index in health_request.json().get('indices', {}).iteritems():
+        for shard_id, shard in index.get('shards', {}).iteritems():
+            if not shard['primary_active'] and not shard['initializing_shards']:
+                failed.append(index_name + '[' + shard_id + ']')
+    return sorted(failed)
+
+
+def recovered_bytes(recovery):
+    ''' Returns the bytes a shard recovery has copied and has to copy. 1.4
+    reports them under index.bytes, later versions under index.size '''
+
+    if 'bytes' in recovery['index']:
+        return recovery['index']['bytes']['recovered'], recovery['index']['bytes']['total']
+    return recovery['index']['size']['recovered_in_bytes'], recovery['index']['size']['total_in_bytes']
+
+
+def report_recovery(batch_name, recoveries, shard_count, batch_size, previous):
+    ''' Prints the progress of a batch being restored and of each shard being
+    recovered, with the throughput since the previous report. Returns what
+    the next report needs to know about this one. '''
+
+    now = time.time()
+    elapsed = now - previous['time'] if previous else None
+
+    def throughput(recovered, previous_recovered):
+        if not elapsed or previous_recovered is None:
+            return ''
+        return '%8.1f MB/s' % ((recovered - previous_recovered) / MB / elapsed)
+
+    recovered = {}
+    for shard_key, recovery in recoveries.iteritems():
+        recovered[shard_key] = recovered_bytes(recovery)[0]
+    total_recovered = sum(recovered.itervalues())
+    done = len([recovery for recovery in recoveries.itervalues() if recovery['stage'] == 'DONE'])
+
+    with output_lock:
+        print '%s %s shards %d/%d done, %d started  %10.1f/%.1f MB %s' % (
+            datetime.now().strftime('%H:%M:%S'), batch_name, done, shard_count, len(recoveries) - done,
+            total_recovered / MB, batch_size / MB, throughput(total_recovered, previous and previous['recovered']))
+
+        for shard_key, recovery in sorted(recoveries.iteritems()):
+            if recovery['stage'] == 'DONE' and previous and previous['shards'].get(shard_key) == recovered[shard_key]:
+                # Finished before the previous report, nothing new to say
+                continue
+            print '    %-40s %-8s %10.1f/%.1f MB %s %s' % (
+                shard_key, recovery['stage'], recovered[shard_key] / MB, recovered_bytes(recovery)[1] / MB,
+                throughput(recovered[shard_key], previous and previous['shards'].get(shard_key)),
+                recovery.get('target', {}).get('name', ''))
+
+    return {'time': now, 'recovered': total_recovered, 'shards': recovered, 'done': done}
+
+
+def restore_batch(es, repo_name, snapshot_id, batch_name, indices, shard_count, batch_size, poll_max):
+    ''' Restores indices from a snapshot and reports their recovery until all
+    shard_count of their primary shards are recovered. Elasticsearch 1.x runs
+    one restore at a time per cluster; while another is still running, waits
+    for it and tries again. Raises if a primary is left unassigned, which is
+    what a failed restore of a shard leaves behind. '''
+
+    restore_data = {'indices': ','.join(indices),
+                    'ignore_unavailable': True,
+                    'include_global_state': False}
+    interval = 1.0
+    while True:
+        restore_request = es.post('/_snapshot/' + repo_name + '/' + snapshot_id + '/_restore',
+                                  data=json.dumps(restore_data))
+        if restore_request.status_code != 503 or \
+                'ConcurrentSnapshotExecutionException' not in restore_request.text:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, poll_max)
+
+    if restore_request.status_code not in [200, 202]:
+        raise RuntimeError('Restore call returned code ' + str(restore_request.status_code) + ' with message ' + restore_request.text)
+    print 'Restore of ' + ', '.join(indices) + ' from snapshot ' + snapshot_id + ' has started.'
+
+    interval = 1.0
+    previous = None
+    failed = []
+    while True:
+        recoveries = get_restore_recovery(es, indices)
+        previous = report_recovery(batch_name, recoveries, shard_count, batch_size, previous)
+        if previous['done'] >= shard_count:
+            return
+        if previous['done'] == len(recoveries):
+            # Nothing is recovering but some primaries are not done. Give
+            # allocation one more poll before taking them as failed.
+            unassigned = get_failed_primaries(es, indices)
+            if unassigned and unassigned == failed:
+                raise RuntimeError('Restore of ' + ', '.join(unassigned) + ' from snapshot ' + snapshot_id + ' failed, the shards are unassigned')
+            failed = unassigned
+        else:
+            failed = []
+        time.sleep(interval)
+        interval = min(interval * 2, poll_max)
+
+
+def run_restore_plan(es, repo_name, snapshot_id, status, batches, poll_max, metrics=MetricsSink()):
+    ''' Restores each batch of indices in turn, so that at most one batch
+    worth of shards is recovering at a time, and publishes how it went.
+    Returns the exit status. '''
+
+    started = time.time()
+    restored = 0
+    restored_shards = 0
+    for number, indices in enumerate(batches):
+        batch_name = 'batch %d/%d' % (number + 1, len(batches))
+        shards = [shard for index_name in indices for shard in status['indices'][index_name]['shards'].itervalues()]
+        shard_count = len(shards)
+        batch_bytes = sum(shard['stats']['total_size_in_bytes'] for shard in shards)
+        batch_started = time.time()
+        try:
+            restore_batch(es, repo_name, snapshot_id, batch_name, indices, shard_count, batch_bytes, poll_max)
+        except Exception, e:
+            print 'Stopping, ' + batch_name + ' could not be restored: ' + str(e)
+            metrics.publish(repo_name, [('RestoreFailed', 1, 'Count')])
+            return EXIT_FAILED
+        seconds = time.time() - batch_started
+        restored += batch_bytes
+        restored_shards += shard_count
+        print 'Restored %s in %.1fs: %d indices, %d shards, %.1f MB at %.1f MB/s' % (
+            batch_name, seconds, len(indices), shard_count, batch_bytes / MB, batch_bytes / MB / max(seconds, 0.001))
+
+    seconds = time.time() - started
+    print 'Restored %d indices from snapshot %s in %.1fs: %.1f MB at %.1f MB/s' % (
+        sum(len(indices) for indices in batches), snapshot_id, seconds, restored / MB, restored / MB / max(seconds, 0.001))
+    metrics.publish(repo_name, [
+        ('RestoreDuration', seconds, 'Seconds'),
+        ('RestoreBytes', restored, 'Bytes'),
+        ('RestoreShards', restored_shards, 'Count'),
+        ('RestoreThroughput', restored / MB / max(seconds, 0.001), 'Megabytes/Second'),
+        ('RestoreFailed', 0, 'Count')])
+    return EXIT_SUCCESS
+
+
+def plan_prune(snapshots, open_indices, keep_hourly, keep_daily, keep_weekly, max_age, run_state={}):
+    ''' Returns the snapshots to delete, oldest first, and the reason each of
+    the others is kept, by snapshot. Snapshots are kept or deleted by run:
+    the group snapshots of one create --group_by, as recorded in run_state
+    by snapshot, or else the snapshot on its own. '''
+
+    runs = {}
+    for snapshot in snapshots:
+        runs.setdefault(run_state.get(snapshot['snapshot'], snapshot['snapshot']), []).append(snapshot)
+
+    def run_started(run_name):
+        return min(snapshot['start_time_in_millis'] for snapshot in runs[run_name]) / 1000.0
+
+    def run_good(run_name):
+        return any(snapshot['state'] in ['SUCCESS', 'PARTIAL'] for snapshot in runs[run_name])
+
+    newest_first = sorted(runs, key=run_started, reverse=True)
+    kept = {}
+
+    for run_name in newest_first:
+        if any(snapshot['state'] == 'IN_PROGRESS' for snapshot in runs[run_name]):
+            kept[run_name] = 'running'
+    for run_name in newest_first:
+        if all(snapshot['state'] == 'SUCCESS' for snapshot in runs[run_name]):
+            kept.setdefault(run_name, 'newest successful')
+            break
+
+    oldest_kept = time.time() - max_age * 86400 if max_age is not None else None
+    policies = [('hourly', keep_hourly, '%Y-%m-%d %H'),
+                ('daily', keep_daily, '%Y-%m-%d'),
+                ('weekly', keep_weekly, '%Y week %W')]
+    for policy, count, bucket_format in policies:
+        buckets = set()
+        for run_name in newest_first:
+            if len(buckets) >= count:
+                break
+            if not run_good(run_name) or (oldest_kept is not None and run_started(run_name) < oldest_kept):
+                continue
+            bucket = datetime.utcfromtimestamp(run_started(run_name)).strftime(bucket_format)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                kept.setdefault(run_name, policy)
+
+    # An open index whose newest copy would go loses its backup: create
+    # --incremental leaves unchanged indices in the snapshot they were in
+    for index_name in open_indices:
+        for run_name in newest_first:
+            if any(snapshot['state'] in ['SUCCESS', 'PARTIAL'] and index_name in snapshot['indices'] and
+                   index_name not in [failure.get('index') for failure in snapshot.get('failures', [])]
+                   for snapshot in runs[run_name]):
+                kept.setdefault(run_name, 'newest copy of ' + index_name)
+                break
+
+    delete = []
+    keep = {}
+    for run_name in reversed(newest_first):
+        for snapshot in sorted(runs[run_name], key=lambda snapshot: snapshot['snapshot']):
+            if run_name in kept:
+                keep[snapshot['snapshot']] = kept[run_name]
+            else:
+                delete.append(snapshot)
+    return delete, keep
+
+
+def delete_snapshot(es, repo_name, snapshot_id, poll_max):
+    ''' Deletes a snapshot. Elasticsearch 1.x turns deletes away while a
+    snapshot is running; waits for it to finish and tries again. '''
+
+    interval = 1.0
+    while True:
+        delete_request = es.delete('/_snapshot/' + repo_name + '/' + snapshot_id,
+                                   timeout=max(es.timeout, SLOW_REQUEST_TIMEOUT))
+        if delete_request.status_code != 503 or \
+                'ConcurrentSnapshotExecutionException' not in delete_request.text:
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, poll_max)
+
+    if delete_request.status_code != 200:
+        raise RuntimeError('Deletion of snapshot returned code ' + str(delete_request.status_code) + ' with message ' + delete_request.text)
+
+
+def run_prune_plan(es, repo_name, delete, poll_max, metrics=MetricsSink(), on_deleted=None):
+    ''' Deletes snapshots one at a time in the order given, timing each
+    delete, and publishes how it went. on_deleted(snapshot_id) is called
+    after each delete. Returns the exit status. '''
+
+    def publish(failed):
+        metrics.publish(repo_name, [
+            ('PruneDeleted', len(timings), 'Count'),
+            ('PruneDuration', sum(timings), 'Seconds'),
+            ('PruneDeleteDurationMax', max(timings or [0]), 'Seconds'),
+            ('PruneFailed', failed, 'Count')])
+
+    timings = []
+    for snapshot in delete:
+        started = time.time()
+        try:
+            delete_snapshot(es, repo_name, snapshot['snapshot'], poll_max)
+        except Exception, e:
+            print 'Stopping, snapshot ' + snapshot['snapshot'] + ' could not be deleted: ' + str(e)
+            publish(1)
+            return EXIT_FAILED
+        timings.append(time.time() - started)
+        if on_deleted:
+            on_deleted(snapshot['snapshot'])
+        print 'Deleted snapshot %s (%s, started %s) in %.1fs' % (
+            snapshot['snapshot'], snapshot['state'],
+            datetime.utcfromtimestamp(snapshot['start_time_in_millis'] / 1000.0).strftime('%Y-%m-%d %H:%M:%S'),
+            timings[-1])
+
+    if timings:
+        print 'Deleted %d snapshots in %.1fs, %.1fs each on average, %.1fs at most' % (
+            len(timings), sum(timings), sum(timings) / len(timings), max(timings))
+    publish(0)
+    return EXIT_SUCCESS
+
+
+def repository_settings(args, base_path, streams, chunk_size):
+    ''' Returns the settings of an S3 repository '''
 
-snapshot = requests.get('http://' + args['<ES_ENDPOINT>'] + ':9200/_snapshot')
-if args['--repo_name'] not in snapshot.json(): 
     snapshot_data = {"type" : "s3", 
                      "settings": {
                         "bucket" : args['--bucket_name'], 
                         "region" : args['--bucket_region'], 
-                        "base_path": args['--key_name_prefix'], 
-                        "concurrent_streams": args['--streams']}}
-    snapshot_create = requests.put('http://' + args['<ES_ENDPOINT>'] + ':9200/_snapshot/' + args['--repo_name'], 
-            data=json.dumps(snapshot_data))
-    if snapshot_create.status_code != 200:
-        raise RuntimeError('Creation of snapshot repository returned code ' + str(snapshot_request.status_code) + '. Unable to create the Elasticsearch snapshot repo in S3 with error: ' + snapshot_create.text)
+                        "base_path": base_path, 
+                        "concurrent_streams": streams}}
+    if chunk_size:
+        snapshot_data['settings']['chunk_size'] = chunk_size
+    if args['--s3_endpoint']:
+        protocol, _, endpoint = args['--s3_endpoint'].rpartition('://')
+        snapshot_data['settings']['endpoint'] = endpoint
+        snapshot_data['settings']['protocol'] = protocol or 'https'
+    return snapshot_data
+
+
+def check_repository(es, args):
+    ''' Creates the snapshot repository in S3 if Elasticsearch does not
+    have it yet '''
+
+    snapshot = es.get('/_snapshot')
+    if snapshot.status_code != 200:
+        raise RuntimeError('Listing snapshot repositories returned code ' + str(snapshot.status_code) + ' with message ' + snapshot.text)
+    if args['--repo_name'] not in snapshot.json(): 
+        snapshot_data = repository_settings(args, args['--key_name_prefix'], args['--streams'], args['--chunk_size'])
+        snapshot_create = es.put('/_snapshot/' + args['--repo_name'], 
+                data=json.dumps(snapshot_data))
+        if snapshot_create.status_code != 200:
+            raise RuntimeError('Creation of snapshot repository returned code ' + str(snapshot_create.status_code) + '. Unable to create the Elasticsearch snapshot repo in S3 with error: ' + snapshot_create.text)
+
+
+@contextmanager
+def repository_lock(state_dir, repo_name):
+    ''' Tries to take an exclusive lock on the repository for the length of
+    the with block, and yields whether it got it. create and prune take it,
+    so that two of them, from cron or the scheduler, never run at once. '''
+
+    path = os.path.join(os.path.expanduser(state_dir), repo_name + '.lock')
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    lock = open(path, 'a')
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+        else:
+            yield True
+    finally:
+        # Closing the file releases the lock
+        lock.close()
+
+
+def create_command(es, args, metrics):
+    ''' Runs create and returns its exit status '''
+
+    with repository_lock(args['--state_dir'], args['--repo_name']) as locked:
+        if not locked:
+            print 'Another create or prune of ' + args['--repo_name'] + ' is running'
+            return EXIT_RUNNING
+        return create_snapshots(es, args, metrics)
+
+
+def create_snapshots(es, args, metrics):
+    ''' Snapshots the indices create is asked for and returns the exit
+    status '''
 
-if args['create']:
     if args['--snapshot_id']:
         snapshot_id = args['--snapshot_id']
     else:
         snapshot_id = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    snapshot_request = requests.put('http://' + args['<ES_ENDPOINT>'] + ':9200/_snapshot/' + args['--repo_name'] + '/' + snapshot_id)
+    if args['--group_by'] and args['--group_by'] not in ['date', 'size']:
+        raise RuntimeError('--group_by must be date or size, not ' + args['--group_by'])
+
+    catalog = SnapshotCatalog(args['--state_dir'], args['--repo_name'])
+    started_snapshots = []
+    index_state = None
+    run_path = run_state_path(args['--state_dir'], args['--repo_name'])
+    run_state = load_state_file(run_path)
+
+    indices = args['--indices']
+    if args['--group_by'] or args['--incremental']:
+        index_stats = get_index_stats(es, indices)
+
+    if args['--incremental']:
+        state_path = index_state_path(args['--state_dir'], args['--repo_name'])
+        index_state = load_state_file(state_path)
+        snapshots = list_snapshots(es, args['--repo_name'])
+        catalog.sync(snapshots)
+        catalog.save()
+        unchanged = unchanged_indices(index_stats, index_state, snapshots)
+        print 'Skipping %d of %d indices, unchanged since they were last snapshotted' % (len(unchanged), len(index_stats))
+        for index_name in unchanged:
+            del index_stats[index_name]
+        if not index_stats:
+            print 'No index has changed, nothing to snapshot'
+            return EXIT_SUCCESS
+        indices = ','.join(sorted(index_stats))
 
-    if snapshot_request.status_code not in [200, 202]: 
-        raise RuntimeError('Creation of snapshot returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+    def on_started(started_snapshot_id, started_indices):
+        started_snapshots.append(started_snapshot_id)
+        if args['--group_by']:
+            # So that prune keeps or deletes the groups together
+            run_state[started_snapshot_id] = snapshot_id
+            save_state_file(run_path, run_state)
+        if index_state is not None:
+            record_snapshot(index_state, started_snapshot_id, started_indices, index_stats)
+            save_state_file(state_path, index_state)
+
+    if args['--group_by']:
+        index_shards = dict((index_name, index['shards']) for index_name, index in index_stats.iteritems())
+        groups = plan_snapshot_groups(index_shards, args['--group_by'], int(args['--group_size']) * MB)
+        started = time.time()
+        result = run_snapshot_plan(es, args['--repo_name'], snapshot_id, groups,
+                                   int(args['--parallel']), float(args['--poll_max']), on_started, metrics)
+        print 'Snapshotted %d groups of indices in %.1fs' % (len(groups), time.time() - started)
     else:
-        print 'Snapshot ' + snapshot_id + ' created.'
-elif args['restore']:
-    restore_data = {'indices' : args['indices'], 
-                    'ignore_unavailable': True, 
-                    'ignore_global_state': True}
-    restore_request = requests.post('http://' + args['<ES_ENDPOINT>'] + ':9200/_snapshot/' + args['--repo_name'] + '/' + args['--snapshot_id'], data=restore_data)
+        snapshot_request = create_snapshot(es, args['--repo_name'], snapshot_id, {'indices': indices})
+
+        if snapshot_request.status_code not in [200, 202]: 
+            raise RuntimeError('Creation of snapshot returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+        else:
+            print 'Snapshot ' + snapshot_id + ' created.'
+            on_started(snapshot_id, sorted(index_stats) if index_state is not None else [])
+
+        result = EXIT_SUCCESS
+        if args['--wait']:
+            result = wait_for_snapshot(es, args['--repo_name'], snapshot_id, float(args['--poll_max']), metrics)
 
-    if restore_request.status_code not in [200, 202]: 
-        raise RuntimeError('Restore call returned code ' + str(restore_request.status_code) + ' with message ' + snapshot_request.text)
+    catalog.update(es, started_snapshots)
+    catalog.save()
+    return result
+
+
+def status_command(es, args, metrics):
+    ''' Runs status and returns its exit status '''
+
+    if args['--wait']:
+        return wait_for_snapshot(es, args['--repo_name'], args['--snapshot_id'], float(args['--poll_max']),
+                                 metrics)
+
+    status = get_snapshot_status(es, args['--repo_name'], args['--snapshot_id'])
+    report_progress(status, None)
+    if status['state'] in RUNNING_STATES:
+        return EXIT_RUNNING
+    return snapshot_result(es, args['--repo_name'], args['--snapshot_id'], status)
+
+
+def restore_command(es, args, metrics):
+    ''' Runs restore and returns its exit status '''
+
+    if args['--snapshot_id']:
+        plans = [(args['--snapshot_id'], args['--indices'])]
+    else:
+        # Every daily index between the dates, from the newest snapshot
+        # holding it, the snapshots with the newest indices first
+        catalog = SnapshotCatalog(args['--state_dir'], args['--repo_name'])
+        catalog.refresh(es, args['--refresh_catalog'])
+        latest = catalog.between(parse_date(args['--from']), parse_date(args['--to']))
+        if not latest:
+            raise RuntimeError('No snapshot holds an index dated from ' + args['--from'] + ' to ' + args['--to'])
+        by_snapshot = {}
+        for index_name, snapshot_id in latest.iteritems():
+            by_snapshot.setdefault(snapshot_id, []).append(index_name)
+        plans = [(snapshot_id, ','.join(sorted(index_names))) for snapshot_id, index_names in
+                 sorted(by_snapshot.iteritems(), key=lambda item: max(item[1]), reverse=True)]
+
+    result = EXIT_SUCCESS
+    for snapshot_id, indices in plans:
+        status = get_snapshot_status(es, args['--repo_name'], snapshot_id)
+        batches = plan_restore_batches(status, indices, int(args['--max_recoveries']))
+        if not batches:
+            raise RuntimeError('Snapshot ' + snapshot_id + ' has no index matching ' + indices)
+        result = max(result, run_restore_plan(es, args['--repo_name'], snapshot_id, status, batches,
+                                              float(args['--poll_max']), metrics), key=EXIT_SEVERITY.index)
+    return result
+
+
+def prune_command(es, args, metrics):
+    ''' Runs prune and returns its exit status '''
+
+    with repository_lock(args['--state_dir'], args['--repo_name']) as locked:
+        if not locked:
+            print 'Another create or prune of ' + args['--repo_name'] + ' is running'
+            return EXIT_RUNNING
+
+        snapshots = list_snapshots(es, args['--repo_name'])
+        catalog = SnapshotCatalog(args['--state_dir'], args['--repo_name'])
+        catalog.sync(snapshots)
+        catalog.save()
+
+        run_path = run_state_path(args['--state_dir'], args['--repo_name'])
+        listed = set(snapshot['snapshot'] for snapshot in snapshots)
+        run_state = dict((snapshot_id, run_name) for snapshot_id, run_name in load_state_file(run_path).iteritems()
+                         if snapshot_id in listed)
+
+        delete, keep = plan_prune(snapshots, get_index_stats(es, '*'),
+                                  int(args['--keep_hourly']), int(args['--keep_daily']), int(args['--keep_weekly']),
+                                  float(args['--max_age']) if args['--max_age'] else None, run_state)
+        for snapshot_id, reason in sorted(keep.iteritems()):
+            print 'Keeping snapshot %s: %s' % (snapshot_id, reason)
+        print '%d snapshots to keep, %d to delete' % (len(keep), len(delete))
+        if args['--dry_run']:
+            for snapshot in delete:
+                print 'Would delete snapshot ' + snapshot['snapshot']
+            return EXIT_SUCCESS
+
+        def on_deleted(snapshot_id):
+            catalog.remove(snapshot_id)
+            catalog.save()
+            run_state.pop(snapshot_id, None)
+            save_state_file(run_path, run_state)
+
+        return run_prune_plan(es, args['--repo_name'], delete, float(args['--poll_max']), metrics, on_deleted)
+
+
+def find_command(es, args):
+    ''' Prints the newest snapshot holding a good copy of --index, or of each
+    daily index dated from --from to --to, and returns the exit status '''
+
+    catalog = SnapshotCatalog(args['--state_dir'], args['--repo_name'])
+    catalog.refresh(es, args['--refresh_catalog'])
+
+    if args['--index']:
+        latest = {args['--index']: catalog.latest(args['--index'])}
+    elif args['--from'] and args['--to']:
+        latest = catalog.between(parse_date(args['--from']), parse_date(args['--to']))
     else:
-        print 'Snapshot restore of ' + args['--snapshot_id'] + ' has started.'
+        raise RuntimeError('find needs --index, or --from and --to')
+
+    found = EXIT_SUCCESS
+    for index_name, snapshot_id in sorted(latest.iteritems(), reverse=True):
+        if not snapshot_id:
+            print '%-40s not in any snapshot' % index_name
+            found = EXIT_FAILED
+            continue
+        snapshot = catalog.snapshots[snapshot_id]
+        size = snapshot['indices'][index_name]
+        print '%-40s %-40s %s %10s' % (index_name, snapshot_id,
+                                       datetime.utcfromtimestamp(snapshot['start'] / 1000.0).strftime('%Y-%m-%d %H:%M:%S'),
+                                       '%.1f MB' % (size / MB) if size is not None else '')
+    if not latest:
+        print 'No snapshot holds an index dated from ' + args['--from'] + ' to ' + args['--to']
+        found = EXIT_FAILED
+    return found
+
+
+def verify_command(es, repo_name):
+    ''' Checks that every node can write to the repository and returns the
+    exit status '''
+
+    verify_request = es.post('/_snapshot/' + repo_name + '/_verify')
+    if verify_request.status_code != 200:
+        print 'Verification of repository ' + repo_name + ' returned code ' + str(verify_request.status_code) + ' with message ' + verify_request.text
+        return EXIT_FAILED
+    nodes = verify_request.json()['nodes']
+    print 'Repository %s verified on %d nodes: %s' % (
+        repo_name, len(nodes), ', '.join(sorted(node['name'] for node in nodes.itervalues())))
+    return EXIT_SUCCESS
+
+
+def create_bench_index(es, index_name, size, shards):
+    ''' Creates an index of random, incompressible documents of about size
+    bytes, flushed to disk so that it is ready to snapshot '''
+
+    index_request = es.put('/' + index_name, data=json.dumps(
+        {'settings': {'number_of_shards': shards, 'number_of_replicas': 0}}))
+    if index_request.status_code != 200:
+        raise RuntimeError('Creation of index returned code ' + str(index_request.status_code) + ' with message ' + index_request.text)
+
+    action = json.dumps({'index': {'_index': index_name, '_type': 'bench'}})
+    loaded = 0
+    while loaded < size:
+        lines = []
+        for n in range(5000):
+            lines.append(action)
+            lines.append(json.dumps({'message': base64.b64encode(os.urandom(768))}))
+        body = '\n'.join(lines) + '\n'
+        bulk_request = es.post('/_bulk', data=body)
+        if bulk_request.status_code != 200 or bulk_request.json().get('errors'):
+            raise RuntimeError('Loading the bench index returned code ' + str(bulk_request.status_code) + ' with message ' + bulk_request.text[:1000])
+        loaded += len(body)
+
+    flush_request = es.post('/' + index_name + '/_flush')
+    if flush_request.status_code != 200:
+        raise RuntimeError('Flushing the bench index returned code ' + str(flush_request.status_code) + ' with message ' + flush_request.text)
+
+
+def bench_snapshot(es, args, repo_name, base_path, streams, chunk_size, index_name, poll_max):
+    ''' Snapshots index_name into a new repository with the settings given,
+    then deletes the snapshot and the repository. Returns the MB/s of the
+    snapshot, or None when it did not succeed. '''
+
+    repo_request = es.put('/_snapshot/' + repo_name, data=json.dumps(
+        repository_settings(args, base_path, streams, chunk_size)))
+    if repo_request.status_code != 200:
+        raise RuntimeError('Creation of snapshot repository returned code ' + str(repo_request.status_code) + ' with message ' + repo_request.text)
+    created = False
+    try:
+        snapshot_request = create_snapshot(es, repo_name, 'bench', {'indices': index_name,
+                                                                    'include_global_state': False})
+        if snapshot_request.status_code not in [200, 202]:
+            raise RuntimeError('Creation of snapshot returned code ' + str(snapshot_request.status_code) + ' with message ' + snapshot_request.text)
+        created = True
+
+        interval = 1.0
+        while True:
+            status = get_snapshot_status(es, repo_name, 'bench')
+            if status['state'] not in RUNNING_STATES:
+                break
+            time.sleep(interval)
+            interval = min(interval * 2, poll_max)
+
+        stats = status['stats']
+        if status['state'] != 'SUCCESS' or status['shards_stats']['failed']:
+            return None
+        return stats['processed_size_in_bytes'] / MB / max(stats['time_in_millis'] / 1000.0, 0.001)
+    finally:
+        if created:
+            delete_snapshot(es, repo_name, 'bench', poll_max)
+        es.delete('/_snapshot/' + repo_name)
+
+
+def bench_command(es, args):
+    ''' Runs bench and returns its exit status '''
+
+    run_id = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    index_name = 'snapshot-bench-' + run_id.lower()
+    poll_max = float(args['--poll_max'])
+    settings = [(int(streams), chunk_size) for streams in args['--bench_streams'].split(',')
+                for chunk_size in args['--bench_chunks'].split(',')]
+
+    print 'Creating %s, %s MB in %s shards' % (index_name, args['--bench_size'], args['--bench_shards'])
+    results = []
+    try:
+        create_bench_index(es, index_name, int(args['--bench_size']) * MB, int(args['--bench_shards']))
+        print '%8s %10s %10s' % ('streams', 'chunk', 'MB/s')
+        for number, (streams, chunk_size) in enumerate(settings):
+            throughput = bench_snapshot(es, args, 'bench-%s-%d' % (run_id, number),
+                                        '%sbench/%s-%d/' % (args['--key_name_prefix'], run_id, number),
+                                        streams, chunk_size, index_name, poll_max)
+            print '%8d %10s %10s' % (streams, chunk_size, '%.1f' % throughput if throughput else 'failed')
+            sys.stdout.flush()
+            if throughput:
+                results.append((throughput, streams, chunk_size))
+    finally:
+        es.delete('/' + index_name)
+
+    if not results:
+        print 'No snapshot succeeded'
+        return EXIT_FAILED
+    fastest = max(results)[0]
+    throughput, streams, chunk_size = min([result for result in results if result[0] >= fastest * 0.95],
+                                          key=lambda result: (result[1], -result[0]))
+    print 'Recommended: --streams %d --chunk_size %s (%.1f MB/s)' % (streams, chunk_size, throughput)
+    return EXIT_SUCCESS
+
+
+def wait_for_repository(es, args):
+    ''' Checks the snapshot repository, as check_repository does, until it
+    succeeds, backing off from 5 seconds to 5 minutes between tries '''
+
+    interval = 5
+    while True:
+        try:
+            check_repository(es, args)
+            return
+        except Exception, e:
+            sys.stderr.write('Repository check failed, trying again in %ds: %s\n' % (interval, e))
+        time.sleep(interval)
+        interval = min(interval * 2, 300)
+
+
+def cluster_queue_depth(es):
+    ''' Returns the longest queue of the bulk, index and search thread pools
+    across the nodes, and which node and pool it is '''
+
+    stats_request = es.get('/_nodes/stats/thread_pool')
+    if stats_request.status_code != 200:
+        raise RuntimeError('Node stats returned code ' + str(stats_request.status_code) + ' with message ' + stats_request.text)
+
+    deepest = (0, None)
+    for node in stats_request.json()['nodes'].itervalues():
+        for pool in ['bulk', 'index', 'search']:
+            queue = node['thread_pool'].get(pool, {}).get('queue', 0)
+            if queue > deepest[0]:
+                deepest = (queue, node.get('name', '') + ' ' + pool)
+    return deepest
+
+
+def wait_for_quiet_cluster(es, max_queue, defer_max):
+    ''' Waits, for up to defer_max seconds, until no bulk, index or search
+    queue is longer than max_queue, so that snapshots do not compete with
+    peak indexing. Returns the seconds waited. '''
+
+    started = time.time()
+    while True:
+        queue, where = cluster_queue_depth(es)
+        waited = time.time() - started
+        if queue <= max_queue:
+            return waited
+        if waited >= defer_max:
+            print 'Running anyway after waiting %.0fs, %d queued on %s' % (waited, queue, where)
+            return waited
+        print 'Cluster busy, %d queued on %s, checking again in a minute' % (queue, where)
+        time.sleep(min(60, defer_max - waited))
+
+
+def schedule_command(es, args, metrics):
+    ''' Runs the create, prune and verify jobs asked for, each every so many
+    minutes, one at a time, until killed '''
+
+    job_args = dict(args)
+    # Each create is followed to its end before the next job starts
+    job_args['--wait'] = True
+    job_args['--snapshot_id'] = None
+    jobs = {'verify': (lambda: verify_command(es, args['--repo_name']), args['--verify_every']),
+            'create': (lambda: create_command(es, job_args, metrics), args['--create_every']),
+            'prune': (lambda: prune_command(es, job_args, metrics), args['--prune_every'])}
+
+    queue = []
+    now = time.time()
+    for order, name in enumerate(['verify', 'create', 'prune']):
+        if jobs[name][1]:
+            heapq.heappush(queue, (now, order, name))
+    if not queue:
+        raise RuntimeError('schedule needs at least one of --create_every, --prune_every and --verify_every')
+
+    while True:
+        due, order, name = heapq.heappop(queue)
+        time.sleep(max(0, due - time.time()))
+        run, every = jobs[name]
+
+        deferred = 0
+        try:
+            if name != 'verify':
+                deferred = wait_for_quiet_cluster(es, int(args['--max_queue']), float(args['--defer_max']) * 60)
+        except Exception, e:
+            # Elasticsearch is most likely unreachable, try again shortly
+            sys.stderr.write('%s postponed, cluster load could not be checked: %s\n' % (name, e))
+            heapq.heappush(queue, (time.time() + 60, order, name))
+            continue
+        print '%s Running %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name)
+        started = time.time()
+        try:
+            result = run()
+        except Exception, e:
+            sys.stderr.write('%s failed: %s\n' % (name, e))
+            result = EXIT_FAILED
+        print '%s Finished %s with exit status %d in %.1fs, deferred %.0fs' % (
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, result, time.time() - started, deferred)
+        sys.stdout.flush()
+
+        # Runs missed while this or another job ran are skipped, not caught up
+        due += float(every) * 60
+        while due <= time.time():
+            due += float(every) * 60
+        if result == EXIT_RUNNING:
+            # Another create or prune held the repository, try again shortly
+            due = min(due, time.time() + 60)
+        heapq.heappush(queue, (due, order, name))
+
+
+args = docopt(__doc__, version='ElasticsearchSnapshot 1.0')
+
+print args
+
+es = ElasticsearchClient(args['<ES_ENDPOINT>'], float(args['--timeout']), int(args['--retries']),
+                         pool_size=max(10, int(args['--parallel'])))
+metrics = get_metrics_sink(args['--metrics'], args['--bucket_region'])
+
+if args['schedule']:
+    wait_for_repository(es, args)
+elif not args['bench'] and not args['find']:
+    check_repository(es, args)
+
+if args['create']:
+    result = create_command(es, args, metrics)
+elif args['status']:
+    result = status_command(es, args, metrics)
+elif args['restore']:
+    result = restore_command(es, args, metrics)
+elif args['prune']:
+    result = prune_command(es, args, metrics)
+elif args['verify']:
+    result = verify_command(es, args['--repo_name'])
+elif args['schedule']:
+    result = schedule_command(es, args, metrics)
+elif args['bench']:
+    result = bench_command(es, args)
+elif args['find']:
+    result = find_command(es, args)
 else:
     print 'Not creating or restoring'
+    result = EXIT_SUCCESS
 
 print 'Process complete'
+sys.exit(result)
@@ -92,6 +92,14 @@ variable named:
 
 Security groups are comma-separated in 'ec2_security_group_ids' and
 'ec2_security_group_names'.
+
+The variables can be narrowed down to the ones playbooks use with
+'hostvars_include' in ec2.ini, and left out of --list altogether with
+'hostvars_in_list', in which case Ansible gets them per host with --host.
+
+To keep the cache warm, run the script with --daemon: it rebuilds the cache
+every 'refresh_interval' seconds, or at once on SIGHUP, so --list and --host
+are always answered from the cache.
 '''
 
 # (c) 2012, Peter Sankauskas
@@ -117,7 +125,13 @@ import sys
 import os
 import argparse
 import re
-from time import time
+import fnmatch
+import mmap
+import fcntl
+import shutil
+import signal
+import threading
+from time import time, sleep
 import boto
 from boto import ec2
 from boto import rds
@@ -125,6 +139,8 @@ from boto import route53
 from boto.ec2 import elb
 import ConfigParser
 from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 try:
     import json
@@ -132,10 +148,109 @@ except ImportError:
     import simplejson as json
 
 
+class UniqueList(list):
+    ''' A list that ignores elements it already holds. Membership is checked
+    against a set rather than by scanning the list, and json writes it out
+    like any other list. '''
+
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self._members = set()
+        for element in iterable:
+            self.add(element)
+
+    def add(self, element):
+        if element not in self._members:
+            self._members.add(element)
+            self.append(element)
+
+
+class BoundedMemo(object):
+    ''' Memoizes a function of one argument in at most 2 * max_size entries.
+    Results are kept in two generations: when the current one is full it
+    becomes the old one, and the results still being asked for are moved
+    back into the new one as they are used, so the cache behaves like an
+    LRU without having to track the order of every lookup. '''
+
+    def __init__(self, function, max_size):
+        self.function = function
+        self.max_size = max_size
+        self.current = {}
+        self.old = {}
+
+    def __call__(self, argument):
+        try:
+            return self.current[argument]
+        except KeyError:
+            pass
+
+        if argument in self.old:
+            result = self.old[argument]
+        else:
+            result = self.function(argument)
+
+        # Worker threads may rotate the generations at the same time; at
+        # worst a result is computed again.
+        if len(self.current) >= self.max_size:
+            self.old = self.current
+            self.current = {}
+        self.current[argument] = result
+        return result
+
+
+class ElbTagDescription(object):
+    ''' An ELB's tags, as one member of a DescribeTags response '''
+
+    def __init__(self, connection=None):
+        self.name = None
+        self.tags = {}
+        self._key = None
+
+    def startElement(self, name, attrs, connection):
+        # boto's XML handler stops sending elements to an object at the end
+        # of the element it was returned for. Taking Tags as well keeps the
+        # nested tag members from ending this one early.
+        if name == 'Tags':
+            return self
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'LoadBalancerName':
+            self.name = value
+        elif name == 'Key':
+            self._key = value
+        elif name == 'Value':
+            self.tags[self._key] = value
+
+
 class Ec2Inventory(object):
+    # Instance attributes that Route53 resource records may point at
+    route53_attributes = [ 'public_dns_name', 'private_dns_name',
+                           'ip_address', 'private_ip_address' ]
+
+    # Hostvars of attributes of these types are a copy of the value
+    hostvar_simple_types = {
+        int: lambda value: value,
+        bool: lambda value: value,
+        str: lambda value: value.strip(),
+        unicode: lambda value: value.strip(),
+        type(None): lambda value: '',
+    }
+
+    # Instance attribute name -> function adding its hostvars, filled in by
+    # compile_hostvar as attributes are first seen
+    hostvar_schema = {}
+
+    # to_safe results. Tag keys, group names and the like repeat across
+    # hosts, so each is only sanitized once.
+    safe_names = BoundedMemo(lambda word: re.sub("[^A-Za-z0-9\-]", "_", word), 10000)
+
     def _empty_inventory(self):
         return {"_meta" : {"hostvars" : {}}}
 
+    def _empty_segment(self):
+        return {"inventory" : self._empty_inventory(), "index" : {}, "lookups" : []}
+
     def __init__(self):
         ''' Main execution path '''
 
@@ -146,28 +261,46 @@ class Ec2Inventory(object):
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Connections to each (service, region), opened once per process
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.connection_stats = defaultdict(lambda: {'opened': 0, 'reused': 0})
+
         # Read settings and parse CLI arguments
         self.read_settings()
         self.parse_cli_args()
 
+        if self.args.daemon:
+            self.run_refresher()
+            return
+
         # Cache
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
+            self.refresh_cache(refresh_all=True)
+        elif self.args.host and os.path.isfile(self.cache_path_cache):
+            # --host is answered from the cache as it stands, --refresh-host
+            # updates just that host rather than the whole inventory
+            pass
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            self.refresh_cache()
 
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info()
 
         elif self.args.list:
-            # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+            # Display list of instances for inventory. The cache file holds
+            # exactly the JSON to print, including right after a refresh.
+            data_to_print = None
 
-        print data_to_print
+        if self.args.stats:
+            self.write_stats(sys.stderr)
+
+        if data_to_print is None:
+            # Copied out as it is rather than loaded and dumped again
+            self.stream_inventory_from_cache(sys.stdout)
+        else:
+            print data_to_print
 
 
     def is_cache_valid(self):
@@ -178,6 +311,10 @@ class Ec2Inventory(object):
             current_time = time()
             if (mod_time + self.cache_max_age) > current_time:
                 if os.path.isfile(self.cache_path_index):
+                    if self.cache_format == 'compact' and not os.path.isfile(self.cache_path_offsets):
+                        return False
+                    if not self.hostvars_in_list and not os.path.isfile(self.cache_path_list):
+                        return False
                     return True
 
         return False
@@ -224,10 +361,22 @@ class Ec2Inventory(object):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
 
+        # How long a zone's cached records are used for while the zone's
+        # record count and SOA serial stay the same. Zone files are written
+        # just before the route53 segment, so this has to be well above
+        # cache_max_age for them to outlive it. With the cache disabled,
+        # zones are not cached either.
+        if config.has_option('ec2', 'route53_zone_max_age'):
+            self.route53_zone_max_age = config.getint('ec2', 'route53_zone_max_age')
+        elif config.getint('ec2', 'cache_max_age') == 0:
+            self.route53_zone_max_age = 0
+        else:
+            self.route53_zone_max_age = max(86400, 10 * config.getint('ec2', 'cache_max_age'))
+
         # ELB
         self.elb_enabled = True
         if config.has_option('ec2', 'elb'):
-            self.elb_enabled = config.get_boolean('ec2', 'elb')
+            self.elb_enabled = config.getboolean('ec2', 'elb')
 
         # Include RDS instances?
         self.rds_enabled = True
@@ -244,6 +393,13 @@ class Ec2Inventory(object):
         else:
             self.all_rds_instances = False
 
+        # Number of API calls allowed in flight at once when refreshing the
+        # cache. 1 keeps the original one-region-at-a-time behaviour.
+        if config.has_option('ec2', 'concurrency'):
+            self.concurrency = max(1, config.getint('ec2', 'concurrency'))
+        else:
+            self.concurrency = 1
+
         # Cache related
         cache_dir = os.path.expanduser(config.get('ec2', 'cache_path'))
         if not os.path.exists(cache_dir):
@@ -251,8 +407,54 @@ class Ec2Inventory(object):
 
         self.cache_path_cache = cache_dir + "/ansible-ec2.cache"
         self.cache_path_index = cache_dir + "/ansible-ec2.index"
+        self.cache_path_offsets = cache_dir + "/ansible-ec2.offsets"
+        self.cache_path_list = cache_dir + "/ansible-ec2.list"
+        self.cache_path_lock = cache_dir + "/ansible-ec2.lock"
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        # Seconds between refreshes in --daemon mode. Half the cache max age
+        # by default, so the cache is rebuilt well before it expires.
+        if config.has_option('ec2', 'refresh_interval'):
+            self.refresh_interval = config.getint('ec2', 'refresh_interval')
+        else:
+            self.refresh_interval = self.cache_max_age / 2
+        self.refresh_interval = max(1, self.refresh_interval)
+
+        # Cache file format: 'json' (indented) or 'compact', which also writes
+        # the offset of each host's vars in the cache to ansible-ec2.offsets
+        self.cache_format = 'json'
+        if config.has_option('ec2', 'cache_format'):
+            self.cache_format = config.get('ec2', 'cache_format')
+        if self.cache_format not in ['json', 'compact']:
+            print("cache_format: %s is not supported, use json or compact." % self.cache_format)
+            sys.exit(1)
+
+        # Per-service and per-region cache segments, refreshed independently
+        self.cache_path_segments = cache_dir + "/ansible-ec2.segments"
+        if not os.path.exists(self.cache_path_segments):
+            os.makedirs(self.cache_path_segments)
+
+        self.segment_max_age = {}
+        if config.has_option('ec2', 'segment_max_age'):
+            for x in config.get('ec2', 'segment_max_age').split(','):
+                segment_name, max_age = x.split('=')
+                self.segment_max_age[segment_name.strip()] = int(max_age)
+
+        # Hostvars to keep, as names or shell-style patterns; all by default
+        self.hostvars_include = []
+        if config.has_option('ec2', 'hostvars_include'):
+            self.hostvars_include = [pattern.strip() for pattern in
+                                     config.get('ec2', 'hostvars_include').split(',')
+                                     if pattern.strip()]
+        self.included_hostvars = {}
+
+        # Leave _meta out of --list, so Ansible asks for each host's vars
+        # with --host, which reads them from the cache
+        if config.has_option('ec2', 'hostvars_in_list'):
+            self.hostvars_in_list = config.getboolean('ec2', 'hostvars_in_list')
+        else:
+            self.hostvars_in_list = True
+
         # Configure nested groups instead of flat namespace.
         if config.has_option('ec2', 'nested_groups'):
             self.nested_groups = config.getboolean('ec2', 'nested_groups')
@@ -286,6 +488,20 @@ class Ec2Inventory(object):
                 filter_key, filter_value = x.split('=')
                 self.ec2_instance_filters[filter_key].append(filter_value)
 
+        # Number of instances to request per DescribeInstances call; 0 asks
+        # for all of a region's instances in one response
+        if config.has_option('ec2', 'page_size'):
+            self.page_size = config.getint('ec2', 'page_size')
+        else:
+            self.page_size = 0
+
+        # Filters every instance must match (ANDed, see get_instance_filter_sets)
+        self.ec2_required_filters = defaultdict(list)
+        if config.has_option('ec2', 'required_instance_filters'):
+            for x in config.get('ec2', 'required_instance_filters', '').split(','):
+                filter_key, filter_value = x.split('=')
+                self.ec2_required_filters[filter_key].append(filter_value)
+
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
@@ -296,32 +512,270 @@ class Ec2Inventory(object):
                            help='Get all the variables about a specific instance')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                            help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+        parser.add_argument('--refresh-host', action='store_true', default=False,
+                           help='With --host, refresh that host from the API and update its cache entry (default: False - use cache files)')
+        parser.add_argument('--stats', action='store_true', default=False,
+                           help='Write how many API connections were opened and reused to stderr (default: False)')
+        parser.add_argument('--daemon', action='store_true', default=False,
+                           help='Keep running and refresh the cache every refresh_interval seconds, or at once on SIGHUP (default: False)')
         self.args = parser.parse_args()
 
 
-    def do_api_calls_update_cache(self):
-        ''' Do API calls to each region, and save data in cache files '''
+    @contextmanager
+    def refresh_lock(self):
+        ''' Holds an exclusive lock on the cache for the length of the with
+        block. Every process that writes the cache takes it, so only one
+        refreshes at a time and the others wait for it to finish. '''
+
+        lock = open(self.cache_path_lock, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock
+            lock.close()
+
+
+    def refresh_cache(self, refresh_all=False):
+        ''' Refreshes the cache, unless another process refreshed it while
+        this one was waiting for the refresh lock. Then N processes finding
+        the cache expired at once make one set of API calls, not N. '''
+
+        requested = time()
+        with self.refresh_lock():
+            if refresh_all:
+                # A refresh that finished after this one was asked for is as
+                # good as doing it again
+                if self.is_cache_valid() and os.path.getmtime(self.cache_path_cache) >= requested:
+                    return
+            elif self.is_cache_valid():
+                return
+
+            self.do_api_calls_update_cache(refresh_all=refresh_all)
+
+
+    def run_refresher(self):
+        ''' Keeps the cache warm until interrupted, so that --list and --host
+        never have to wait for AWS. The cache is rebuilt every
+        refresh_interval seconds from the segments that have expired, and
+        from all of them at once on SIGHUP (or straight away with
+        --refresh-cache). A refresh that fails is reported on stderr and
+        leaves the cache as it was. '''
+
+        self.refresh_requested = self.args.refresh_cache
+
+        def request_refresh(signum, frame):
+            self.refresh_requested = True
+        signal.signal(signal.SIGHUP, request_refresh)
+
+        while True:
+            refresh_all = self.refresh_requested
+            self.refresh_requested = False
+            started = time()
+            try:
+                with self.refresh_lock():
+                    self.do_api_calls_update_cache(refresh_all=refresh_all)
+            except (Exception, SystemExit), e:
+                sys.stderr.write('Cache refresh failed: %s\n' % (e,))
+
+            # sleep() returns early when a signal is handled
+            next_refresh = started + self.refresh_interval
+            while not self.refresh_requested and time() < next_refresh:
+                sleep(next_refresh - time())
+
 
+    def do_api_calls_update_cache(self, refresh_all=False):
+        ''' Do API calls to each region for the cache segments that have
+        expired, or for all of them with refresh_all, and save data in cache
+        files '''
+
+        self.inventory = self._empty_inventory()
+        self.index = {}
+
+        builders = []
         if self.route53_enabled:
-            self.get_route53_records()
+            builders.append((('route53', None), self.get_route53_records, (refresh_all,)))
 
+        for region in self.regions:
+            if self.elb_enabled:
+                builders.append((('elb', region), self.get_elb_records, (region,)))
+            builders.append((('ec2', region), self.build_ec2_segment, (region,)))
+            if self.rds_enabled:
+                builders.append((('rds', region), self.build_rds_segment, (region,)))
+
+        calls = []
+        for key, function, args in builders:
+            if refresh_all or not self.is_segment_valid(key):
+                calls.append((key, function, args))
+
+        segments = self.run_api_calls(calls)
+        for key, segment in segments.iteritems():
+            self.write_to_cache(segment, self.segment_cache_path(key))
+
+        def take_segment(key):
+            # Each segment is only held until it has been merged; the ones
+            # still valid in the cache are read just before that
+            if key in segments:
+                return segments.pop(key)
+            return self.load_segment_from_cache(key)
+
+        # Merge in the same order a serial run would, so the inventory does
+        # not depend on which call happened to finish first
+        self.route53_records = take_segment(('route53', None)) if self.route53_enabled else {}
+        self.elb_records = {}
         if self.elb_enabled:
-            self.get_elb_records()
+            for region in self.regions:
+                self.elb_records.update(take_segment(('elb', region)))
 
         for region in self.regions:
-            self.get_instances_by_region(region)
+            self.merge_segment(take_segment(('ec2', region)))
             if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
+                self.merge_segment(take_segment(('rds', region)))
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
+        self.write_inventory_to_cache(self.inventory)
         self.write_to_cache(self.index, self.cache_path_index)
 
 
-    def get_instances_by_region(self, region):
-        ''' Makes an AWS EC2 API call to the list of instances in a particular
-        region '''
+    def segment_cache_path(self, key):
+        ''' Returns the cache file of a (service, region) segment '''
+
+        return os.path.join(self.cache_path_segments, self.segment_name(key) + '.json')
+
+    def segment_name(self, key):
+        ''' Returns the name of a (service, region) segment, e.g. ec2-us-east-1 '''
+
+        service, region = key
+        if region is None:
+            return service
+        return service + '-' + region
+
+    def is_segment_valid(self, key):
+        ''' Determines if a segment's cache file has expired. The max age can
+        be set per segment name or per service with segment_max_age. '''
+
+        path = self.segment_cache_path(key)
+        if not os.path.isfile(path):
+            return False
+
+        max_age = self.segment_max_age.get(self.segment_name(key),
+                      self.segment_max_age.get(key[0], self.cache_max_age))
+        return (os.path.getmtime(path) + max_age) > time()
+
+    def load_segment_from_cache(self, key):
+        ''' Reads a segment from its cache file '''
+
+        cache = open(self.segment_cache_path(key), 'r')
+        segment = json.loads(cache.read())
+        cache.close()
+        return segment
+
+
+    def build_ec2_segment(self, region):
+        ''' Builds the cache segment holding a region's EC2 instances '''
+
+        segment = self._empty_segment()
+        for instance in self.get_instances_by_region(region):
+            self.add_instance(instance, region, segment)
+        return segment
+
+    def build_rds_segment(self, region):
+        ''' Builds the cache segment holding a region's RDS instances '''
+
+        segment = self._empty_segment()
+        for instance in self.get_rds_instances_by_region(region):
+            self.add_rds_instance(instance, region, segment)
+        return segment
+
+    def merge_segment(self, segment):
+        ''' Merges a segment's inventory and index into self.inventory and
+        self.index, then adds its hosts to their ELB and Route53 groups. The
+        segment's groups are emptied as they are merged, so that each list is
+        freed once it has been copied. '''
+
+        for key in segment['inventory'].keys():
+            group = segment['inventory'].pop(key)
+            if key == '_meta':
+                self.inventory['_meta']['hostvars'].update(group['hostvars'])
+            elif isinstance(group, dict):
+                for element in group.get('hosts', []):
+                    self.push(self.inventory, key, element)
+                for element in group.get('children', []):
+                    self.push_group(self.inventory, key, element)
+            else:
+                for element in group:
+                    self.push(self.inventory, key, element)
+
+        self.index.update(segment['index'])
+
+        for dest, instance_id, addresses in segment['lookups']:
+            # Inventory: Group by ELBs
+            if self.elb_enabled:
+                for name in self.get_instance_elb_names(instance_id):
+                    self.push(self.inventory, name, dest)
+                    if self.nested_groups:
+                        self.push_group(self.inventory, 'elb', name)
+
+            # Inventory: Group by Route53 domain names if enabled
+            if self.route53_enabled:
+                for name in self.get_instance_route53_names(addresses):
+                    self.push(self.inventory, name, dest)
+                    if self.nested_groups:
+                        self.push_group(self.inventory, 'route53', name)
+
+
+    def run_api_calls(self, calls):
+        ''' Runs a list of (key, function, args) API calls, at most
+        self.concurrency at a time, and returns a dict of key to result '''
 
+        if self.concurrency <= 1 or len(calls) <= 1:
+            return dict((key, function(*args)) for key, function, args in calls)
+
+        pool = ThreadPool(min(self.concurrency, len(calls)))
+        try:
+            outcomes = pool.map(self._run_api_call, calls)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = {}
+        for key, exit_status, result in outcomes:
+            if exit_status is not None:
+                # The call gave up the way the serial path does; exit the
+                # same way from the main thread
+                raise exit_status
+            results[key] = result
+        return results
+
+    def _run_api_call(self, call):
+        ''' Worker side of run_api_calls. sys.exit() in a pool thread would
+        kill the worker without a result, so it is handed back instead. '''
+
+        key, function, args = call
         try:
+            return key, None, function(*args)
+        except SystemExit, e:
+            return key, e, None
+
+
+    def get_connection(self, service, region):
+        ''' Returns the connection to a service ('ec2', 'rds', 'elb' or
+        'route53') in a region, opening it the first time it is asked for and
+        reusing it afterwards. Each (service, region) is only used by one API
+        call at a time, so connections are not shared between threads. '''
+
+        key = (service, region)
+        with self.connections_lock:
+            if key in self.connections:
+                self.connection_stats[service]['reused'] += 1
+            else:
+                self.connections[key] = self.connect(service, region)
+                self.connection_stats[service]['opened'] += 1
+            return self.connections[key]
+
+    def connect(self, service, region):
+        ''' Opens a new connection to a service in a region '''
+
+        if service == 'ec2':
             if self.eucalyptus:
                 conn = boto.connect_euca(host=self.eucalyptus_host)
                 conn.APIVersion = '2010-08-31'
@@ -332,17 +786,51 @@ class Ec2Inventory(object):
             if conn is None:
                 print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
                 sys.exit(1)
+            return conn
+        elif service == 'rds':
+            # None when RDS is not available in the region
+            return rds.connect_to_region(region)
+        elif service == 'elb':
+            return elb.connect_to_region(region)
+        elif service == 'route53':
+            return route53.Route53Connection()
 
-            reservations = []
-            if self.ec2_instance_filters:
-                for filter_key, filter_values in self.ec2_instance_filters.iteritems():
-                    reservations.extend(conn.get_all_instances(filters = { filter_key : filter_values }))
-            else:
-                reservations = conn.get_all_instances()
+    def write_stats(self, out):
+        ''' Writes how many connections to each service were opened and how
+        many times they were reused '''
 
-            for reservation in reservations:
-                for instance in reservation.instances:
-                    self.add_instance(instance, region)
+        for service in sorted(self.connection_stats):
+            stats = self.connection_stats[service]
+            out.write("%s: %d connections opened, %d reused\n" %
+                      (service, stats['opened'], stats['reused']))
+
+
+    def get_instances_by_region(self, region):
+        ''' Makes AWS EC2 API calls to the list of instances in a particular
+        region and yields them. With page_size set, the instances are
+        requested a page at a time, and each page is yielded before the next
+        one is requested. '''
+
+        try:
+            conn = self.get_connection('ec2', region)
+
+            # Calls with different filters can return the same instance
+            instance_ids = set()
+            for filters in self.get_instance_filter_sets():
+                next_token = None
+                while True:
+                    reservations = conn.get_all_reservations(filters = filters,
+                                                             max_results = self.page_size or None,
+                                                             next_token = next_token)
+                    for reservation in reservations:
+                        for instance in reservation.instances:
+                            if instance.id not in instance_ids:
+                                instance_ids.add(instance.id)
+                                yield instance
+
+                    next_token = reservations.next_token
+                    if not next_token:
+                        break
 
         except boto.exception.BotoServerError, e:
             if  not self.eucalyptus:
@@ -350,43 +838,75 @@ class Ec2Inventory(object):
             print e
             sys.exit(1)
 
+    def get_instance_filter_sets(self):
+        ''' Returns the filters for each DescribeInstances call made per
+        region. instance_filters with different keys are ORed, so each key
+        needs a call of its own. required_instance_filters, and the running
+        state unless all_instances is set, are ANDed into every call so AWS
+        does not send instances that add_instance would skip. '''
+
+        required = dict(self.ec2_required_filters)
+        if not self.all_instances and not self.eucalyptus:
+            required.setdefault('instance-state-name', ['running'])
+
+        if not self.ec2_instance_filters:
+            return [required]
+
+        filter_sets = []
+        for filter_key, filter_values in self.ec2_instance_filters.iteritems():
+            filters = dict(required)
+            if filter_key in required:
+                filter_values = [v for v in filter_values if v in required[filter_key]]
+                if not filter_values:
+                    # Nothing can match both, so there is no call to make
+                    continue
+            filters[filter_key] = filter_values
+            filter_sets.append(filters)
+        return filter_sets
+
     def get_rds_instances_by_region(self, region):
         ''' Makes an AWS API call to the list of RDS instances in a particular
-        region '''
+        region and returns them '''
 
         try:
-            conn = rds.connect_to_region(region)
+            conn = self.get_connection('rds', region)
             if conn:
-                instances = conn.get_all_dbinstances()
-                for instance in instances:
-                    self.add_rds_instance(instance, region)
+                return conn.get_all_dbinstances()
         except boto.exception.BotoServerError, e:
             if not e.reason == "Forbidden":
                 print "Looks like AWS RDS is down: "
                 print e
                 sys.exit(1)
+        return []
 
     def get_instance(self, region, instance_id):
         ''' Gets details about a specific instance '''
-        if self.eucalyptus:
-            conn = boto.connect_euca(self.eucalyptus_host)
-            conn.APIVersion = '2010-08-31'
-        else:
-            conn = ec2.connect_to_region(region)
-
-        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-        if conn is None:
-            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-            sys.exit(1)
+        conn = self.get_connection('ec2', region)
 
         reservations = conn.get_all_instances([instance_id])
         for reservation in reservations:
             for instance in reservation.instances:
                 return instance
 
-    def add_instance(self, instance, region):
-        ''' Adds an instance to the inventory and index, as long as it is
-        addressable '''
+    def get_rds_instance(self, region, instance_id):
+        ''' Gets details about a specific RDS instance '''
+
+        try:
+            conn = self.get_connection('rds', region)
+            if conn:
+                for instance in conn.get_all_dbinstances(instance_id):
+                    return instance
+        except boto.exception.BotoServerError, e:
+            if e.status != 404:
+                print "Looks like AWS RDS is down: "
+                print e
+                sys.exit(1)
+
+    def add_instance(self, instance, region, segment):
+        ''' Adds an instance to a cache segment's inventory and index, as long
+        as it is addressable '''
+
+        inventory = segment['inventory']
 
         # Only want running instances unless all_instances is True
         if not self.all_instances and instance.state != 'running':
@@ -411,44 +931,44 @@ class Ec2Inventory(object):
             return
 
         # Add to index
-        self.index[dest] = [region, instance.id]
+        segment['index'][dest] = [region, instance.id]
 
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        inventory[instance.id] = [dest]
         if self.nested_groups:
-            self.push_group(self.inventory, 'instances', instance.id)
+            self.push_group(inventory, 'instances', instance.id)
 
         # Inventory: Group by region
         if self.nested_groups:
-            self.push_group(self.inventory, 'regions', region)
+            self.push_group(inventory, 'regions', region)
         else:
-            self.push(self.inventory, region, dest)
+            self.push(inventory, region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.placement, dest)
+        self.push(inventory, instance.placement, dest)
         if self.nested_groups:
-            self.push_group(self.inventory, region, instance.placement)
+            self.push_group(inventory, region, instance.placement)
 
         # Inventory: Group by instance type
         type_name = self.to_safe('type_' + instance.instance_type)
-        self.push(self.inventory, type_name, dest)
+        self.push(inventory, type_name, dest)
         if self.nested_groups:
-            self.push_group(self.inventory, 'types', type_name)
+            self.push_group(inventory, 'types', type_name)
 
         # Inventory: Group by key pair
         if instance.key_name:
             key_name = self.to_safe('key_' + instance.key_name)
-            self.push(self.inventory, key_name, dest)
+            self.push(inventory, key_name, dest)
             if self.nested_groups:
-                self.push_group(self.inventory, 'keys', key_name)
+                self.push_group(inventory, 'keys', key_name)
         
         # Inventory: Group by security group
         try:
             for group in instance.groups:
                 key = self.to_safe("security_group_" + group.name)
-                self.push(self.inventory, key, dest)
+                self.push(inventory, key, dest)
                 if self.nested_groups:
-                    self.push_group(self.inventory, 'security_groups', key)
+                    self.push_group(inventory, 'security_groups', key)
         except AttributeError:
             print 'Package boto seems a bit older.'
             print 'Please upgrade boto >= 2.3.0.'
@@ -457,36 +977,28 @@ class Ec2Inventory(object):
         # Inventory: Group by tag keys
         for k, v in instance.tags.iteritems():
             key = self.to_safe("tag_" + k + "=" + v)
-            self.push(self.inventory, key, dest)
+            self.push(inventory, key, dest)
             if self.nested_groups:
-                self.push_group(self.inventory, 'tags', self.to_safe("tag_" + k))
-                self.push_group(self.inventory, self.to_safe("tag_" + k), key)
-
-        # Inventory: Group by ELBs
-        if self.elb_enabled: 
-            elb_names = self.get_instance_elb_names(instance)
-            for name in elb_names:
-                self.push(self.inventory, name, dest)
-                if self.nested_groups:
-                    self.push_group(self.inventory, 'elb', name)
+                self.push_group(inventory, 'tags', self.to_safe("tag_" + k))
+                self.push_group(inventory, self.to_safe("tag_" + k), key)
 
-        # Inventory: Group by Route53 domain names if enabled
-        if self.route53_enabled:
-            route53_names = self.get_instance_route53_names(instance)
-            for name in route53_names:
-                self.push(self.inventory, name, dest)
-                if self.nested_groups:
-                    self.push_group(self.inventory, 'route53', name)
+        # Inventory: Group by ELBs and Route53 domain names. Those records are
+        # cached in segments of their own, so the lookup happens when this
+        # segment is merged into the inventory.
+        addresses = [getattr(instance, attrib, None) for attrib in self.route53_attributes]
+        segment['lookups'].append([dest, instance.id, addresses])
 
         # Global Tag: tag all EC2 instances
-        self.push(self.inventory, 'ec2', dest)
+        self.push(inventory, 'ec2', dest)
 
-        self.inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
+        inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
 
 
-    def add_rds_instance(self, instance, region):
-        ''' Adds an RDS instance to the inventory and index, as long as it is
-        addressable '''
+    def add_rds_instance(self, instance, region, segment):
+        ''' Adds an RDS instance to a cache segment's inventory and index, as
+        long as it is addressable '''
+
+        inventory = segment['inventory']
 
         # Only want available instances unless all_rds_instances is True
         if not self.all_rds_instances and instance.status != 'available':
@@ -504,37 +1016,37 @@ class Ec2Inventory(object):
             return
 
         # Add to index
-        self.index[dest] = [region, instance.id]
+        segment['index'][dest] = [region, instance.id]
 
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        inventory[instance.id] = [dest]
         if self.nested_groups:
-            self.push_group(self.inventory, 'instances', instance.id)
+            self.push_group(inventory, 'instances', instance.id)
 
         # Inventory: Group by region
         if self.nested_groups:
-            self.push_group(self.inventory, 'regions', region)
+            self.push_group(inventory, 'regions', region)
         else:
-            self.push(self.inventory, region, dest)
+            self.push(inventory, region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.availability_zone, dest)
+        self.push(inventory, instance.availability_zone, dest)
         if self.nested_groups:
-            self.push_group(self.inventory, region, instance.availability_zone)
+            self.push_group(inventory, region, instance.availability_zone)
         
         # Inventory: Group by instance type
         type_name = self.to_safe('type_' + instance.instance_class)
-        self.push(self.inventory, type_name, dest)
+        self.push(inventory, type_name, dest)
         if self.nested_groups:
-            self.push_group(self.inventory, 'types', type_name)
+            self.push_group(inventory, 'types', type_name)
         
         # Inventory: Group by security group
         try:
             if instance.security_group:
                 key = self.to_safe("security_group_" + instance.security_group.name)
-                self.push(self.inventory, key, dest)
+                self.push(inventory, key, dest)
                 if self.nested_groups:
-                    self.push_group(self.inventory, 'security_groups', key)
+                    self.push_group(inventory, 'security_groups', key)
 
         except AttributeError:
             print 'Package boto seems a bit older.'
@@ -542,128 +1054,228 @@ class Ec2Inventory(object):
             sys.exit(1)
 
         # Inventory: Group by engine
-        self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
+        self.push(inventory, self.to_safe("rds_" + instance.engine), dest)
         if self.nested_groups:
-            self.push_group(self.inventory, 'rds_engines', self.to_safe("rds_" + instance.engine))
+            self.push_group(inventory, 'rds_engines', self.to_safe("rds_" + instance.engine))
 
         # Inventory: Group by parameter group
-        self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
+        self.push(inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
         if self.nested_groups:
-            self.push_group(self.inventory, 'rds_parameter_groups', self.to_safe("rds_parameter_group_" + instance.parameter_group.name))
+            self.push_group(inventory, 'rds_parameter_groups', self.to_safe("rds_parameter_group_" + instance.parameter_group.name))
 
         # Global Tag: all RDS instances
-        self.push(self.inventory, 'rds', dest)
+        self.push(inventory, 'rds', dest)
 
-        self.inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
+        inventory["_meta"]["hostvars"][dest] = self.get_host_info_dict_from_instance(instance)
 
 
-    def get_route53_records(self):
-        ''' Get and store the map of resource records to domain names that
-        point to them. '''
+    def get_route53_records(self, refresh_all=False):
+        ''' Get the map of resource records to domain names that point to
+        them. With refresh_all, every zone is downloaded again rather than
+        read from its cache. '''
 
-        r53_conn = route53.Route53Connection()
+        r53_conn = self.get_connection('route53', None)
         all_zones = r53_conn.get_zones()
 
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
 
-        self.route53_records = {}
+        route53_records = {}
 
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            for resource, names in self.get_route53_zone_records(r53_conn, zone, refresh_all).iteritems():
+                route53_records.setdefault(resource, set())
+                route53_records[resource].update(names)
 
-            for record_set in rrsets:
-                record_name = record_set.name
+        return dict((resource, sorted(names)) for resource, names in route53_records.iteritems())
 
-                if record_name.endswith('.'):
-                    record_name = record_name[:-1]
+    def get_route53_zone_records(self, r53_conn, zone, refresh_all=False):
+        ''' Get a zone's map of resource records to domain names. The map is
+        cached per zone and only downloaded again with refresh_all, when the
+        zone's serial has changed or when its cache file is older than
+        route53_zone_max_age. '''
 
-                for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+        key = ('route53', zone.id)
+        serial = self.get_route53_zone_serial(r53_conn, zone)
 
-    def get_elb_records(self, region): 
-        ''' Get and store the map of instance id to ELB resource name '''
+        if not refresh_all and os.path.isfile(self.segment_cache_path(key)):
+            mod_time = os.path.getmtime(self.segment_cache_path(key))
+            if (mod_time + self.route53_zone_max_age) > time():
+                cached = self.load_segment_from_cache(key)
+                if cached['serial'] == serial:
+                    return cached['records']
 
-        
-        self.elb_records = {}
+        zone_records = {}
+
+        for record_set in r53_conn.get_all_rrsets(zone.id):
+            record_name = record_set.name
+
+            if record_name.endswith('.'):
+                record_name = record_name[:-1]
+
+            for resource in record_set.resource_records:
+                zone_records.setdefault(resource, set())
+                zone_records[resource].add(record_name)
+
+        zone_records = dict((resource, sorted(names)) for resource, names in zone_records.iteritems())
+        self.write_to_cache({'serial': serial, 'records': zone_records}, self.segment_cache_path(key))
+        return zone_records
 
-        for zone in elb_zones:
-            elb_conn = elb.ElbConnection(region=region)
+    def get_route53_zone_serial(self, r53_conn, zone):
+        ''' Returns a value that changes when records are added to or removed
+        from a zone: the zone's record set count and SOA serial. Route53
+        never changes the SOA serial by itself, so a record whose value is
+        changed in place goes unnoticed until the cache expires. Costs one
+        single-record API call. '''
 
-            for lb in elb_conn.get_all_load_balancers():
-                elb_name = lb.name
+        soa_serial = ''
+        for record_set in r53_conn.get_all_rrsets(zone.id, type='SOA', name=zone.name, maxitems=1):
+            if record_set.type == 'SOA' and record_set.resource_records:
+                # mname rname serial refresh retry expire minimum
+                soa_serial = record_set.resource_records[0].split()[2]
+            break
+
+        return '%s:%s' % (getattr(zone, 'resourcerecordsetcount', ''), soa_serial)
+
+    def get_elb_records(self, region):
+        ''' Get the map of instance id to the ELBs serving it in a region.
+        Each ELB is known by its name and, for ELBs created by CloudFormation
+        such as the ELK stack's elasticsearchInternalElb, its logical id. '''
+
+        elb_records = {}
+
+        try:
+            elb_conn = self.get_connection('elb', region)
+            if elb_conn is None:
+                # ELB is not available in the region
+                return elb_records
+
+            load_balancers = []
+            marker = None
+            while True:
+                page = elb_conn.get_all_load_balancers(marker = marker)
+                load_balancers.extend(page)
+                marker = page.next_marker
+                if not marker:
+                    break
+
+            logical_ids = self.get_elb_logical_ids(elb_conn, [lb.name for lb in load_balancers])
+
+            for lb in load_balancers:
+                elb_names = [lb.name]
+                if lb.name in logical_ids:
+                    elb_names.append(logical_ids[lb.name])
 
                 for instance in lb.instances:
-                    self.elb_records.setdefault(instance.id, set())
-                    self.elb_records[instance.id].add(elb_name)
-    
-    def get_instance_elb_names(self, instance):
-        ''' check if an instance is referenced in the records we have from
-        ELB. If it is, return the list of ELB Names which serve the instance
-        referenced. If nothing points to it, return an empty list. '''
+                    elb_records.setdefault(instance.id, set())
+                    elb_records[instance.id].update(elb_names)
 
-        lb_list = set()
+        except boto.exception.BotoServerError, e:
+            print "Looks like AWS ELB is down: "
+            print e
+            sys.exit(1)
 
-        try: 
-            value = getattr(instance, 'id')
-        except AttributeError:
-            pass
+        return dict((instance_id, sorted(names)) for instance_id, names in elb_records.iteritems())
 
-        return list(self.elb_records.get(value, []))
+    def get_elb_logical_ids(self, elb_conn, elb_names):
+        ''' Returns a map of ELB name to the CloudFormation logical id it was
+        created under, for the ELBs that have one. boto has no call for ELB
+        tags, so DescribeTags is made directly, 20 ELBs at a time. '''
 
+        logical_ids = {}
+        for start in range(0, len(elb_names), 20):
+            params = {}
+            elb_conn.build_list_params(params, elb_names[start:start + 20],
+                                       'LoadBalancerNames.member.%d')
+            for description in elb_conn.get_list('DescribeTags', params,
+                                                 [('member', ElbTagDescription)]):
+                if 'aws:cloudformation:logical-id' in description.tags:
+                    logical_ids[description.name] = description.tags['aws:cloudformation:logical-id']
+        return logical_ids
 
-    def get_instance_route53_names(self, instance):
-        ''' Check if an instance is referenced in the records we have from
-        Route53. If it is, return the list of domain names pointing to said
-        instance. If nothing points to it, return an empty list. '''
 
-        instance_attributes = [ 'public_dns_name', 'private_dns_name',
-                                'ip_address', 'private_ip_address' ]
+    def get_instance_elb_names(self, instance_id):
+        ''' check if an instance is referenced in the records we have from
+        ELB. If it is, return the list of ELB Names which serve the instance
+        referenced. If nothing points to it, return an empty list. '''
 
-        name_list = set()
+        return sorted(self.elb_records.get(instance_id, []))
 
-        for attrib in instance_attributes:
-            try:
-                value = getattr(instance, attrib)
-            except AttributeError:
-                continue
 
+    def get_instance_route53_names(self, addresses):
+        ''' Check if any of an instance's addresses is referenced in the
+        records we have from Route53. If it is, return the list of domain
+        names pointing to said instance. If nothing points to it, return an
+        empty list. '''
+
+        name_list = set()
+
+        for value in addresses:
             if value in self.route53_records:
                 name_list.update(self.route53_records[value])
 
-        return list(name_list)
+        return sorted(name_list)
 
 
     def get_host_info_dict_from_instance(self, instance):
         instance_vars = {}
-        for key in vars(instance):
-            value = getattr(instance, key)
-            key = self.to_safe('ec2_' + key)
+        for attribute, value in vars(instance).iteritems():
+            try:
+                add_vars = self.hostvar_schema[attribute]
+            except KeyError:
+                add_vars = self.hostvar_schema[attribute] = self.compile_hostvar(attribute)
+            add_vars(instance_vars, instance, value)
+
+        if self.hostvars_include:
+            instance_vars = dict((key, value) for key, value in instance_vars.iteritems()
+                                 if self.is_hostvar_included(key))
+
+        return instance_vars
+
+    def is_hostvar_included(self, key):
+        ''' Checks a hostvar name against hostvars_include. The answer is
+        kept, as the same names come up for every host. '''
 
-            # Handle complex types
-            # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
-            if key == 'ec2__state':
+        try:
+            return self.included_hostvars[key]
+        except KeyError:
+            included = any(fnmatch.fnmatchcase(key, pattern) for pattern in self.hostvars_include)
+            self.included_hostvars[key] = included
+            return included
+
+    def compile_hostvar(self, attribute):
+        ''' Returns the function that adds the hostvars for an instance
+        attribute: f(instance_vars, instance, value). Compiled once per
+        attribute name, so the sanitized key and the handling of the
+        attribute are worked out once rather than for every instance. '''
+
+        key = self.to_safe('ec2_' + attribute)
+
+        # Handle complex types
+        # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
+        if key == 'ec2__state':
+            def add_vars(instance_vars, instance, value):
                 instance_vars['ec2_state'] = instance.state or ''
                 instance_vars['ec2_state_code'] = instance.state_code
-            elif key == 'ec2__previous_state':
+            return add_vars
+        elif key == 'ec2__previous_state':
+            def add_vars(instance_vars, instance, value):
                 instance_vars['ec2_previous_state'] = instance.previous_state or ''
                 instance_vars['ec2_previous_state_code'] = instance.previous_state_code
-            elif type(value) in [int, bool]:
-                instance_vars[key] = value
-            elif type(value) in [str, unicode]:
-                instance_vars[key] = value.strip()
-            elif type(value) == type(None):
-                instance_vars[key] = ''
-            elif key == 'ec2_region':
+            return add_vars
+
+        if key == 'ec2_region':
+            def add_complex_vars(instance_vars, value):
                 instance_vars[key] = value.name
-            elif key == 'ec2__placement':
+        elif key == 'ec2__placement':
+            def add_complex_vars(instance_vars, value):
                 instance_vars['ec2_placement'] = value.zone
-            elif key == 'ec2_tags':
+        elif key == 'ec2_tags':
+            def add_complex_vars(instance_vars, value):
                 for k, v in value.iteritems():
-                    key = self.to_safe('ec2_tag_' + k)
-                    instance_vars[key] = v
-            elif key == 'ec2_groups':
+                    instance_vars[self.to_safe('ec2_tag_' + k)] = v
+        elif key == 'ec2_groups':
+            def add_complex_vars(instance_vars, value):
                 group_ids = []
                 group_names = []
                 for group in value:
@@ -671,52 +1283,160 @@ class Ec2Inventory(object):
                     group_names.append(group.name)
                 instance_vars["ec2_security_group_ids"] = ','.join([str(i) for i in group_ids])
                 instance_vars["ec2_security_group_names"] = ','.join([str(i) for i in group_names])
-            else:
-                pass
-                # TODO Product codes if someone finds them useful
-                #print key
-                #print type(value)
-                #print value
+        else:
+            # TODO Product codes if someone finds them useful
+            add_complex_vars = None
 
-        return instance_vars
+        simple_types = self.hostvar_simple_types
+
+        def add_vars(instance_vars, instance, value):
+            convert = simple_types.get(type(value))
+            if convert is not None:
+                instance_vars[key] = convert(value)
+            elif add_complex_vars is not None:
+                add_complex_vars(instance_vars, value)
+        return add_vars
 
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
+        if self.args.refresh_host:
+            host_vars = self.refresh_host_info(self.args.host)
+        elif self.inventory != self._empty_inventory():
+            host_vars = self.inventory['_meta']['hostvars'].get(self.args.host, {})
+        else:
+            # host might not exist anymore if it is not in the cache
+            host_vars = self.get_host_info_from_cache(self.args.host)
+
+        return self.json_format_dict(host_vars, True)
+
+    def refresh_host_info(self, host):
+        ''' Gets the variables of a single host from the API and updates its
+        entry in the cache files, leaving the rest of the cache untouched '''
+
         if len(self.index) == 0:
             # Need to load index from cache
             self.load_index_from_cache()
 
-        if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
-                # host migh not exist anymore
-                return self.json_format_dict({}, True)
+        if not host in self.index:
+            return {}
+
+        (region, instance_id) = self.index[host]
+
+        if instance_id.startswith('i-'):
+            service = 'ec2'
+            instance = self.get_instance(region, instance_id)
+        else:
+            service = 'rds'
+            instance = self.get_rds_instance(region, instance_id)
+
+        if instance is None:
+            # host migh not exist anymore
+            return {}
+
+        host_vars = self.get_host_info_dict_from_instance(instance)
+
+        with self.refresh_lock():
+            self.update_cached_host_info(self.cache_path_cache, host, host_vars)
+            self.update_cached_host_info(self.segment_cache_path((service, region)),
+                                         host, host_vars, segment=True)
+        return host_vars
+
+    def update_cached_host_info(self, filename, host, host_vars, segment=False):
+        ''' Replaces one host's variables in an inventory or segment cache
+        file. The file keeps its modification time, so the rest of its
+        contents do not look any fresher than they are. '''
+
+        if not os.path.isfile(filename):
+            return
+
+        mod_time = os.path.getmtime(filename)
+        cache = open(filename, 'r')
+        data = json.loads(cache.read())
+        cache.close()
 
-        (region, instance_id) = self.index[self.args.host]
+        inventory = data['inventory'] if segment else data
+        if host not in inventory['_meta']['hostvars']:
+            return
 
-        instance = self.get_instance(region, instance_id)
-        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+        inventory['_meta']['hostvars'][host] = host_vars
+        if segment:
+            self.write_to_cache(data, filename)
+        else:
+            self.write_inventory_to_cache(data)
+        os.utime(filename, (mod_time, mod_time))
+
+    def get_host_info_from_cache(self, host):
+        ''' Reads the variables of a specific host from the inventory cache
+        file. With the compact format only that host's vars are read, from
+        the offset recorded for it. '''
+
+        if self.cache_format == 'compact' and os.path.isfile(self.cache_path_offsets):
+            offsets = open(self.cache_path_offsets, 'r')
+            host_offsets = json.loads(offsets.read())
+            offsets.close()
+
+            if host in host_offsets:
+                cache = open(self.cache_path_cache, 'rb')
+                try:
+                    host_vars = self.read_host_vars(cache, host, *host_offsets[host])
+                finally:
+                    cache.close()
+                if host_vars is not None:
+                    return host_vars
+
+            # Read during a refresh, the offsets file can be older or newer
+            # than the cache file. Unless they agree on the host, the whole
+            # of the cache file decides.
+
+        inventory = json.loads(self.get_inventory_from_cache())
+        return inventory['_meta']['hostvars'].get(host, {})
+
+    def read_host_vars(self, cache, host, offset, length):
+        ''' Reads a host's vars from the compact cache file at the offset and
+        length recorded for them. Returns None unless the bytes there are
+        the vars of that host, which they may not be if the cache file has
+        been replaced since the offsets were read. '''
+
+        key = self.json_format_dict(host) + ':'
+        cache_map = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if offset < len(key) or offset + length >= len(cache_map):
+                return None
+            if cache_map[offset - len(key):offset] != key:
+                return None
+            if cache_map[offset + length] not in ',}':
+                return None
+            try:
+                return json.loads(cache_map[offset:offset + length])
+            except ValueError:
+                return None
+        finally:
+            cache_map.close()
 
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
         the dict '''
-        group_info = my_dict.setdefault(key, [])
+        group_info = my_dict.get(key)
         if isinstance(group_info, dict):
-            host_list = group_info.setdefault('hosts', [])
-            host_list.append(element)
+            self.unique_list(group_info, 'hosts').add(element)
         else:
-            group_info.append(element)
+            self.unique_list(my_dict, key).add(element)
 
     def push_group(self, my_dict, key, element):
         ''' Push a group as a child of another group. '''
         parent_group = my_dict.setdefault(key, {})
         if not isinstance(parent_group, dict):
             parent_group = my_dict[key] = {'hosts': parent_group}
-        child_groups = parent_group.setdefault('children', [])
-        if element not in child_groups:
-            child_groups.append(element)
+        self.unique_list(parent_group, 'children').add(element)
+
+    def unique_list(self, my_dict, key):
+        ''' Returns my_dict[key] as a UniqueList, creating it or converting a
+        plain list (e.g. one loaded from a cache file) in place '''
+        elements = my_dict.get(key)
+        if not isinstance(elements, UniqueList):
+            elements = my_dict[key] = UniqueList(elements or [])
+        return elements
 
     def get_inventory_from_cache(self):
         ''' Reads the inventory from the cache file and returns it as a JSON
@@ -727,6 +1447,18 @@ class Ec2Inventory(object):
         return json_inventory
 
 
+    def stream_inventory_from_cache(self, out):
+        ''' Copies the inventory cache file, or the list file when hostvars
+        are left out of the list, to out in chunks, followed by a newline '''
+
+        cache = open(self.cache_path_cache if self.hostvars_in_list else self.cache_path_list, 'rb')
+        try:
+            shutil.copyfileobj(cache, out)
+        finally:
+            cache.close()
+        out.write('\n')
+
+
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
@@ -735,31 +1467,96 @@ class Ec2Inventory(object):
         self.index = json.loads(json_index)
 
 
+    @contextmanager
+    def open_cache_file(self, filename):
+        ''' Opens a temporary file next to filename for writing, and renames
+        it over filename once the with block completes. Readers see either
+        the old or the new file in full, never a half-written one. '''
+
+        temp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        cache = open(temp_filename, 'wb')
+        try:
+            yield cache
+            cache.close()
+            os.rename(temp_filename, filename)
+        except:
+            cache.close()
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            raise
+
+
     def write_to_cache(self, data, filename):
         ''' Writes data in JSON format to a file '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        with self.open_cache_file(filename) as cache:
+            if self.cache_format == 'compact':
+                # json only uses its C encoder when keys are not sorted
+                cache.write(json.dumps(data, separators=(',', ':')))
+            else:
+                # Streamed to the file rather than built up as one string first
+                json.dump(data, cache, sort_keys=True, indent=2)
+
+
+    def write_inventory_to_cache(self, inventory):
+        ''' Writes the inventory to the inventory cache file in the configured
+        cache format, and the groups alone to the list file when hostvars
+        are left out of the list '''
+
+        if not self.hostvars_in_list:
+            groups = dict((key, value) for key, value in inventory.iteritems() if key != '_meta')
+            self.write_to_cache(groups, self.cache_path_list)
+
+        if self.cache_format != 'compact':
+            self.write_to_cache(inventory, self.cache_path_cache)
+            return
+
+        # Compact JSON with _meta first, so every host's vars sit in one run
+        # of bytes whose offset and length are kept in the offsets file
+        host_offsets = {}
+        hostvars = inventory['_meta']['hostvars']
+        with self.open_cache_file(self.cache_path_cache) as cache:
+            cache.write('{"_meta":{"hostvars":{')
+            position = cache.tell()
+            separator = ''
+            for host in sorted(hostvars):
+                prefix = separator + self.json_format_dict(host) + ':'
+                host_vars = self.json_format_dict(hostvars[host], compact=True)
+                cache.write(prefix)
+                cache.write(host_vars)
+                host_offsets[host] = [position + len(prefix), len(host_vars)]
+                position += len(prefix) + len(host_vars)
+                separator = ','
+            cache.write('}}')
+
+            for key in sorted(inventory):
+                if key != '_meta':
+                    cache.write(',' + self.json_format_dict(key) + ':' +
+                                self.json_format_dict(inventory[key], compact=True))
+            cache.write('}')
+
+        self.write_to_cache(host_offsets, self.cache_path_offsets)
 
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be
-        used as Ansible groups '''
+        used as Ansible groups. Memoized in safe_names. '''
 
-        return re.sub("[^A-Za-z0-9\-]", "_", word)
+        return self.safe_names(word)
 
 
-    def json_format_dict(self, data, pretty=False):
+    def json_format_dict(self, data, pretty=False, compact=False):
         ''' Converts a dict to a JSON object and dumps it as a formatted
         string '''
 
         if pretty:
             return json.dumps(data, sort_keys=True, indent=2)
+        elif compact:
+            return json.dumps(data, sort_keys=True, separators=(',', ':'))
         else:
             return json.dumps(data)
 
 
 # Run the script
-Ec2Inventory()
+if __name__ == '__main__':
+    Ec2Inventory()